@@ -1,10 +1,11 @@
 from fastapi import FastAPI
 
-from app.apis.routers import story
+from app.apis.routers import metrics, story
 
 app = FastAPI()
 
 app.include_router(story.router)
+app.include_router(metrics.router)
 
 @app.get("/", tags=["Root"])
 async def root():
@@ -23,3 +23,9 @@ class TaskStatusResponse(BaseModel):
 
 class AllTasksResponse(BaseModel):
     tasks: list[TaskStatusResponse]
+
+
+class QuotaResponse(BaseModel):
+    limit: int | None = None
+    remaining: int | None = None
+    reset: int | None = None
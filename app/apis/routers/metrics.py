@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+
+from app.apis.models import QuotaResponse
+from app.core.rate_limit import get_pexels_bucket
+
+router = APIRouter()
+
+
+@router.get("/pexels_quota", response_model=QuotaResponse)
+async def get_pexels_quota():
+    """
+    Fetch the Pexels request quota last reported to the workers.
+
+    Returns:
+        QuotaResponse: The quota limit, the remaining requests and the reset time as a UNIX timestamp.
+            Fields are empty until a worker has made a request.
+    """
+    return QuotaResponse(**get_pexels_bucket().get_quota())
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from app import config
+
+
+class AssetStore:
+    """Downloaded images shared by every task on the host, stored once per content hash.
+
+    Search responses are indexed by (query, orientation) and expire after `query_ttl`
+    seconds. Files are indexed by (photo id, rendition URL). When the files exceed
+    `max_bytes`, the least recently used ones are evicted. The perceptual hash of each file
+    is kept alongside, so near-duplicate photos can be skipped before they are downloaded.
+    """
+
+    def __init__(self, path: str, max_bytes: int, query_ttl: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.query_ttl = query_ttl
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS queries (query TEXT, orientation TEXT, photos TEXT, expires_at REAL, PRIMARY KEY (query, orientation))")
+            conn.execute("CREATE TABLE IF NOT EXISTS files (digest TEXT PRIMARY KEY, size INTEGER, accessed_at REAL, phash TEXT)")
+            if "phash" not in [column[1] for column in conn.execute("PRAGMA table_info(files)")]:
+                conn.execute("ALTER TABLE files ADD COLUMN phash TEXT")
+            conn.execute("CREATE TABLE IF NOT EXISTS photos (photo_id TEXT, url TEXT, digest TEXT, PRIMARY KEY (photo_id, url))")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_accessed_at ON files (accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS photos_digest ON photos (digest)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(os.path.join(self.path, "index.sqlite3"), timeout=30)
+
+    def _file_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], f"{digest}.jpg")
+
+    def get_query(self, query: str, orientation: str) -> Optional[List[dict]]:
+        """Returns the photos of a cached search response, or None if it is missing or expired."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT photos, expires_at FROM queries WHERE query = ? AND orientation = ?", (query, orientation)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def put_query(self, query: str, orientation: str, photos: List[dict]):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)", (query, orientation, json.dumps(photos), time.time() + self.query_ttl))
+
+    def get_photo(self, photo_id, url: str) -> str:
+        """Returns the stored file of a photo rendition, or "" if it is not stored."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT digest FROM photos WHERE photo_id = ? AND url = ?", (str(photo_id), url)).fetchone()
+            if row is None:
+                return ""
+            file_path = self._file_path(row[0])
+            if not os.path.exists(file_path):
+                conn.execute("DELETE FROM photos WHERE digest = ?", (row[0],))
+                conn.execute("DELETE FROM files WHERE digest = ?", (row[0],))
+                return ""
+            conn.execute("UPDATE files SET accessed_at = ? WHERE digest = ?", (time.time(), row[0]))
+        return file_path
+
+    def put_photo(self, photo_id, url: str, downloaded_file: str) -> str:
+        """Moves a downloaded file into the store and indexes it under a photo rendition.
+
+        Returns:
+            str: The stored file. Identical content is stored once.
+        """
+        sha256 = hashlib.sha256()
+        with open(downloaded_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        file_path = self._file_path(digest)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if os.path.exists(file_path):
+            os.remove(downloaded_file)
+        else:
+            os.replace(downloaded_file, file_path)
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO files (digest, size, accessed_at) VALUES (?, ?, ?) ON CONFLICT (digest) DO UPDATE SET accessed_at = excluded.accessed_at",
+                (digest, os.path.getsize(file_path), now),
+            )
+            conn.execute("INSERT OR REPLACE INTO photos VALUES (?, ?, ?)", (str(photo_id), url, digest))
+            self._evict(conn, keep=digest)
+        return file_path
+
+    def get_hash(self, photo_id) -> Optional[int]:
+        """Returns the perceptual hash of any stored rendition of a photo, or None if none is known."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT files.phash FROM photos JOIN files ON files.digest = photos.digest WHERE photos.photo_id = ? AND files.phash IS NOT NULL",
+                (str(photo_id),),
+            ).fetchone()
+        return int(row[0], 16) if row else None
+
+    def set_hash(self, photo_id, phash: int):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE files SET phash = ? WHERE digest IN (SELECT digest FROM photos WHERE photo_id = ?)", (f"{phash:016x}", str(photo_id))
+            )
+
+    def _evict(self, conn: sqlite3.Connection, keep: str):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        freed = 0
+        digests = []
+        for digest, size in conn.execute("SELECT digest, size FROM files WHERE digest != ? ORDER BY accessed_at", (keep,)):
+            digests.append(digest)
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
+
+        for digest in digests:
+            # Task folders hold hard links, so removing the stored file does not break a running task
+            try:
+                os.remove(self._file_path(digest))
+            except FileNotFoundError:
+                pass
+        conn.executemany("DELETE FROM files WHERE digest = ?", [(digest,) for digest in digests])
+        conn.executemany("DELETE FROM photos WHERE digest = ?", [(digest,) for digest in digests])
+        logger.info(f"Evicted {len(digests)} images from {self.path}")
+
+    @staticmethod
+    def link(file_path: str, destination: str) -> str:
+        """Hard-links a stored file into a task folder, copying it when linking is not possible.
+
+        Raises `FileNotFoundError` if the stored file has been evicted in the meantime.
+        """
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(file_path, destination)
+        except OSError:
+            shutil.copyfile(file_path, destination)
+        return destination
+
+
+_store = None
+_store_created = False
+
+
+def get_asset_store() -> Optional[AssetStore]:
+    """Returns the image store configured under `cache.images` in config.yaml, or None if it is disabled."""
+    global _store, _store_created
+    if _store_created:
+        return _store
+
+    store_config = config.get("cache", {}).get("images", {})
+    if store_config.get("backend", "none") == "disk":
+        try:
+            _store = AssetStore(
+                path=store_config.get("path", "./cache/images"),
+                max_bytes=int(store_config.get("max_mb", 2048) * 1024 * 1024),
+                query_ttl=int(store_config.get("query_ttl_hours", 24) * 3600),
+            )
+        except Exception as e:
+            logger.warning(f"Cannot create the image store: {e}. Caching is disabled")
+    _store_created = True
+    return _store
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Optional
+
+from loguru import logger
+
+from app import config
+
+
+def make_key(*parts) -> str:
+    """Builds a content-addressed key from JSON-serializable parts."""
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """A key-value cache in a SQLite file, shared by every process on the host.
+
+    Entries expire after `ttl` seconds. When the values exceed `max_bytes`, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, ttl: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, expires_at REAL, accessed_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", (key, value, size, now + self.ttl, now))
+            self._evict(conn, now)
+
+    def delete(self, key: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        freed = 0
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed_at"):
+            keys.append((key,))
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
+        conn.executemany("DELETE FROM cache WHERE key = ?", keys)
+        logger.info(f"Evicted {len(keys)} entries from {self.path}")
+
+
+class RedisCache:
+    """A key-value cache in Redis, shared by every worker.
+
+    Entries expire after `ttl` seconds. Size-based eviction is left to the server's
+    `maxmemory` and `maxmemory-policy allkeys-lru` settings.
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(self.prefix + key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+
+_caches = {}
+
+
+def get_cache(name: str):
+    """Returns the cache configured under `cache.<name>` in config.yaml, or None if it is disabled.
+
+    Falls back to no cache, with a warning, when the backend cannot be created.
+    """
+    if name in _caches:
+        return _caches[name]
+
+    cache_config = config.get("cache", {}).get(name, {})
+    backend = cache_config.get("backend", "none")
+    ttl = int(cache_config.get("ttl_hours", 24 * 30) * 3600)
+
+    cache = None
+    try:
+        if backend == "disk":
+            cache = DiskCache(
+                path=cache_config.get("path", f"./cache/{name}.sqlite3"),
+                ttl=ttl,
+                max_bytes=int(cache_config.get("max_mb", 64) * 1024 * 1024),
+            )
+        elif backend == "redis":
+            cache = RedisCache(url=cache_config.get("redis_url") or os.getenv("REDIS_URL", ""), ttl=ttl, prefix=f"{name}:")
+    except Exception as e:
+        logger.warning(f"Cannot create {backend} cache '{name}': {e}. Caching is disabled")
+
+    _caches[name] = cache
+    return cache
@@ -0,0 +1,244 @@
+import functools
+import json
+import os
+import re
+import shutil
+import subprocess
+from typing import List
+
+import imageio_ffmpeg
+from loguru import logger
+
+from app.core.models.schema import MediaInfo
+
+
+def get_ffmpeg_exe() -> str:
+    """Returns the ffmpeg binary used by moviepy, so every stage runs the same build."""
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+@functools.lru_cache(maxsize=1)
+def get_ffprobe_exe() -> str:
+    """Returns the ffprobe binary, preferring the one next to ffmpeg, or "" if there is none.
+
+    The ffmpeg build bundled with imageio-ffmpeg comes without ffprobe.
+    """
+    ffprobe = os.path.join(os.path.dirname(get_ffmpeg_exe()), "ffprobe")
+    if os.path.exists(ffprobe):
+        return ffprobe
+    ffprobe = shutil.which("ffprobe") or ""
+    if not ffprobe:
+        logger.warning("ffprobe not found, reading media information from the ffmpeg banner instead")
+    return ffprobe
+
+
+def _parse_ffmpeg_info(output: str) -> MediaInfo:
+    # e.g. "Stream #0:0(und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, bt709), 1080x1920 [SAR 1:1 DAR 9:16], 30 fps, 30 tbr"
+    info = MediaInfo()
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        info.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    stream = re.search(r"Stream #\d+:\d+.*?: Video: (.*)", output)
+    if stream is None:
+        return info
+    stream = stream.group(1)
+    codec = re.match(r"(\w+)[^,]*, (\w+)", stream)
+    if codec:
+        info.codec, info.pix_fmt = codec.groups()
+    size = re.search(r", (\d+)x(\d+)", stream)
+    if size:
+        info.width, info.height = int(size.group(1)), int(size.group(2))
+    # tbr is the rate ffprobe reports as r_frame_rate
+    fps = re.search(r"([\d.]+) tbr", stream) or re.search(r"([\d.]+) fps", stream)
+    if fps:
+        info.fps = float(fps.group(1))
+    return info
+
+
+def _probe_with_ffmpeg(path: str) -> MediaInfo:
+    result = subprocess.run([get_ffmpeg_exe(), "-hide_banner", "-i", path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = result.stderr.decode("utf-8", errors="ignore")
+    # Without an output file ffmpeg always exits with an error, a readable input still prints its streams
+    if "Duration:" not in output:
+        raise RuntimeError(f"ffmpeg cannot read {path}: {output.strip()}")
+    return _parse_ffmpeg_info(output)
+
+
+@functools.lru_cache(maxsize=256)
+def _probe(path: str, mtime_ns: int, size: int) -> MediaInfo:
+    if not get_ffprobe_exe():
+        return _probe_with_ffmpeg(path)
+
+    cmd = [
+        get_ffprobe_exe(),
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=codec_name,width,height,r_frame_rate,pix_fmt:format=duration",
+        "-of",
+        "json",
+        path,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr.decode('utf-8', errors='ignore').strip()}")
+
+    data = json.loads(result.stdout)
+    stream = (data.get("streams") or [{}])[0]
+    numerator, _, denominator = stream.get("r_frame_rate", "0/1").partition("/")
+    denominator = float(denominator or 1)
+    return MediaInfo(
+        duration=float(data.get("format", {}).get("duration", 0.0)),
+        width=int(stream.get("width", 0)),
+        height=int(stream.get("height", 0)),
+        fps=float(numerator) / denominator if denominator else 0.0,
+        codec=stream.get("codec_name", ""),
+        pix_fmt=stream.get("pix_fmt", ""),
+    )
+
+
+def probe(path: str) -> MediaInfo:
+    """Reads duration, size, fps and codec of a media file without opening a decoder.
+
+    Results are cached per file, and invalidated when the file changes.
+
+    Args:
+        path (str): Path of the media file.
+
+    Returns:
+        MediaInfo: The media information. Video fields are empty for audio-only files.
+    """
+    stat = os.stat(path)
+    return _probe(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def run_ffmpeg(args: List[str]):
+    """Runs ffmpeg with the given arguments and raises if it fails.
+
+    Args:
+        args (List[str]): Arguments passed to ffmpeg, without the binary itself.
+    """
+    cmd = [get_ffmpeg_exe(), "-y", "-hide_banner", "-loglevel", "error", *args]
+    logger.debug(f"Running: {' '.join(cmd)}")
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', errors='ignore').strip()}")
+
+
+def open_rawvideo_writer(
+    output_file: str,
+    width: int,
+    height: int,
+    fps: int,
+    pix_fmt: str = "bgr24",
+    codec: str = "libx264",
+    preset: str = "veryfast",
+    crf: int = 20,
+) -> subprocess.Popen:
+    """Starts an ffmpeg process that encodes raw frames written to its stdin.
+
+    Args:
+        output_file (str): Path of the encoded video.
+        width (int): Frame width in pixels.
+        height (int): Frame height in pixels.
+        fps (int): Frames per second.
+        pix_fmt (str, optional): Pixel format of the raw frames. Defaults to "bgr24" (OpenCV order).
+        codec (str, optional): Video encoder. Defaults to "libx264".
+        preset (str, optional): Encoder preset. Defaults to "veryfast".
+        crf (int, optional): Constant rate factor. Defaults to 20.
+
+    Returns:
+        subprocess.Popen: The running ffmpeg process. Write frames to `stdin`, then call `communicate()`.
+    """
+    cmd = [
+        get_ffmpeg_exe(),
+        "-y",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        pix_fmt,
+        "-s",
+        f"{width}x{height}",
+        "-r",
+        str(fps),
+        "-i",
+        "-",
+        "-an",
+        "-c:v",
+        codec,
+        "-preset",
+        preset,
+        "-crf",
+        str(crf),
+        "-pix_fmt",
+        "yuv420p",
+        output_file,
+    ]
+    logger.debug(f"Running: {' '.join(cmd)}")
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def concat_videos(video_paths: List[str], output_file: str, audio_file: str = "") -> str:
+    """Joins videos that share encoding parameters with stream copy, without re-encoding.
+
+    Args:
+        video_paths (List[str]): Videos to join, in order.
+        output_file (str): Path of the joined video.
+        audio_file (str, optional): Audio track muxed into the output. The inputs' audio is dropped if given.
+
+    Returns:
+        str: The output video path.
+    """
+    list_file = f"{output_file}.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for video_path in video_paths:
+            escaped_path = os.path.abspath(video_path).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", list_file]
+    if audio_file:
+        args += ["-i", audio_file, "-map", "0:v", "-map", "1:a", "-shortest"]
+    args += ["-c", "copy", "-movflags", "+faststart", output_file]
+
+    try:
+        run_ffmpeg(args)
+    finally:
+        os.remove(list_file)
+
+    logger.info(f"Joined {len(video_paths)} videos into {output_file}")
+    return output_file
+
+
+def _escape_filter_value(value: str) -> str:
+    # First for the filter option parser, then for the filtergraph parser
+    value = value.replace("\\", "/").replace("'", "\\'").replace(":", "\\:")
+    for char in "\\,;[]":
+        value = value.replace(char, f"\\{char}")
+    return value
+
+
+def ass_filter(subtitle_file: str, fonts_dir: str = "", offset: float = 0.0) -> str:
+    """Builds a video filter that burns an ASS subtitle file in with libass.
+
+    Args:
+        subtitle_file (str): Path of the ASS file.
+        fonts_dir (str, optional): Directory searched for the fonts referenced by the styles.
+        offset (float, optional): Position of the first frame on the subtitle timeline, in seconds.
+            Used when the video is a segment cut from a longer timeline.
+
+    Returns:
+        str: The filter, to be passed with `-vf`.
+    """
+    subtitle_filter = f"ass={_escape_filter_value(os.path.abspath(subtitle_file))}"
+    if fonts_dir:
+        subtitle_filter += f":fontsdir={_escape_filter_value(os.path.abspath(fonts_dir))}"
+    if offset:
+        subtitle_filter = f"setpts=PTS+{offset:.3f}/TB,{subtitle_filter},setpts=PTS-STARTPTS"
+    return subtitle_filter
@@ -1,3 +1,5 @@
+import asyncio
+import math
 import os
 import glob
 import shutil
@@ -6,39 +8,160 @@ from uuid import uuid4
 from loguru import logger
 
 from app import config
+from app.core import retry
 from app.core.story import fetch_random_vi_story, fetch_short_story, fetch_all_available_morals, fetch_all_stories
-from app.core.images import get_images, image2video
-from app.core.voice import create_voice_and_subtitle
-from app.core.video import generate_video, combine_videos
-from app.core.llm import generate_terms, translate_to_vietnamese, generate_story_from_moral
-from app.core.models.schema import VideoParams
+from app.core.images import acquire_images, render_clips
+from app.core.voice import create_voice_and_subtitle, acreate_voice_and_subtitle_from_stream
+from app.core.video import generate_video, combine_videos, generate_video_from_images, generate_video_segmented
+from app.core.llm import (
+    generate_terms,
+    agenerate_terms,
+    agenerate_story_from_moral,
+    agenerate_story_bundle,
+    astream_story_sentences,
+)
+from app.core.models.schema import VideoAspect, VideoParams
+from app.core.story_bank import get_story_bank
+from app.core.translation import atranslate_moral, lookup, remember
 
 _max_retries = 3
 
 
 _voice_rate = config["video"].get("voice_rate", 1.0)
 _language = config["video"].get("language", "English").lower().strip()
+_combined_generation = config["llm"].get("combined_generation", False)
+# Streaming starts the voice sooner but takes two LLM calls per story instead of one, see _astream_story_and_voice
+_streaming_tts = config["video"].get("streaming_tts", False)
+_max_image_duration = config["video"].get("max_image_duration", 10)
+
+
+async def _aprepare_story(moral: str) -> dict:
+    if _combined_generation:
+        story = await agenerate_story_bundle(moral)
+        if _language == "vietnamese":
+            # A known translation wins over the generated one, and a new one is saved for next time
+            known = lookup(moral)
+            if known:
+                story["moral"] = known
+            else:
+                remember(moral, story["moral"])
+        return story
+
+    # The story prompt already asks for the configured language, so the moral is translated alongside it
+    if _language == "vietnamese":
+        moral, story = await asyncio.gather(atranslate_moral(moral), agenerate_story_from_moral(moral))
+    else:
+        story = await agenerate_story_from_moral(moral)
+    return {"moral": moral, "story": story}
+
 
+async def _astream_story_and_voice(moral: str, audio_path: str, voice_name: str, params: VideoParams) -> tuple:
+    """Streams the story into TTS sentence by sentence, while the moral is translated.
 
-def generate_video_from_moral(moral: str, task_id: str) -> str:
+    The voice starts before the story is complete, at the cost of a second LLM call for the
+    search terms, which the combined generation gets in the same call as the story. That call
+    starts as soon as the story is streamed, so it runs while TTS finishes.
+    """
+    queue = asyncio.Queue()
+    terms = []
+
+    async def produce():
+        streamed = []
+        try:
+            async for sentence in astream_story_sentences(moral):
+                streamed.append(sentence)
+                await queue.put(sentence)
+        finally:
+            await queue.put(None)
+        terms.append(asyncio.ensure_future(agenerate_terms(" ".join(streamed), amount=5)))
+
+    producer = asyncio.ensure_future(produce())
+    moral_translated = await atranslate_moral(moral) if _language == "vietnamese" else moral
+
+    story_sentences = []
+
+    async def sentences():
+        yield moral_translated
+        while (sentence := await queue.get()) is not None:
+            story_sentences.append(sentence)
+            yield sentence
+
+    try:
+        subtitle_output_file, audio_duration, _ = await acreate_voice_and_subtitle_from_stream(
+            voice_name=voice_name,
+            sentences=sentences(),
+            voice_output_file=audio_path,
+            voice_rate=_voice_rate,
+            subtitle_format=params.subtitle_format,
+            params=params,
+        )
+    except BaseException:
+        producer.cancel()
+        for task in terms:
+            task.cancel()
+        raise
+    # Raises if the stream failed, instead of returning a truncated story
+    await producer
+
+    story = {"moral": moral_translated, "story": " ".join(story_sentences), "search_terms": await terms[0]}
+    return story, subtitle_output_file, audio_duration
+
+
+def generate_video_from_moral(moral: str, task_id: str, story: dict = None) -> str:
+    """Creates a video telling a story about a moral.
+
+    Args:
+        moral (str): The moral, in English or in the video language.
+        task_id (str): The task, used as the name of the working folder.
+        story (dict, optional): A story bank entry to use. By default the bank is looked up
+            by moral, and the story is generated only when it has none.
+
+    Returns:
+        str: The path of the video, or "" if it cannot be created.
+    """
+    # Every retry made for this video, at any level, shares one budget
+    with retry.task_budget():
+        return _generate_video_from_moral(moral, task_id, story=story)
+
+
+def _generate_video_from_moral(moral: str, task_id: str, story: dict = None) -> str:
     if not moral:
         logger.error("moral cannot be empty")
         return ""
 
-    if _language == "vietnamese":
-        moral = translate_to_vietnamese(moral)
+    # Create a temp folder to store the resources
+    output_folder = os.path.join("temp", task_id)
+    os.makedirs(output_folder, exist_ok=True)
+
+    params = VideoParams()
+    audio_path = os.path.join(output_folder, "audio.mp3")
+    voice_name = "en-US-AndrewNeural-Male" if _language == "english" else "vi-VN-NamMinhNeural"
+
+    if story is None:
+        story = get_story_bank().get(moral)
+    if story is not None:
+        logger.info(f"Using the pre-generated story for moral '{moral}'")
+
+    subtitle_output_file, audio_duration = "", 0.0
+    if story is None and _streaming_tts:
+        try:
+            story, subtitle_output_file, audio_duration = asyncio.run(_astream_story_and_voice(moral, audio_path, voice_name, params))
+        except Exception as e:
+            logger.warning(f"Cannot stream the story into TTS: {e}. Generating it in one go")
+            story = None
 
-    story = {"moral": moral, "story": generate_story_from_moral(moral)}
+    if story is None:
+        story = asyncio.run(_aprepare_story(moral))
     if not story["story"]:
         logger.error(f"Failed to generate story from moral '{moral}'")
         return ""
 
-    # Create a temp folder to store the resources
-    output_folder = os.path.join("temp", task_id)
-    os.makedirs(output_folder, exist_ok=True)
-
     # Retrieve search terms if exist:
     for attemp in range(_max_retries):
+        if retry.budget_exhausted():
+            logger.error(f"Task {task_id} has no retry budget left")
+            break
+
         try:
             logger.info(f"Creating a video from moral. Try {attemp}")
 
@@ -46,44 +169,71 @@ def generate_video_from_moral(moral: str, task_id: str) -> str:
             if not search_terms:
                 search_terms = generate_terms(content=story["story"], amount=5)
 
+            # The voice comes first, so only as many images as the timeline needs are fetched
+            if not audio_duration:
+                subtitle_output_file, audio_duration = create_voice_and_subtitle(
+                    voice_name=voice_name,
+                    text=story["moral"] + "\n" + story["story"],
+                    voice_output_file=audio_path,
+                    voice_rate=_voice_rate,
+                    subtitle_format=params.subtitle_format,
+                    params=params,
+                )
+            assert audio_duration > 0, "Cannot create the voice"
+
             images_folder = os.path.join(output_folder, "images")
             os.makedirs(images_folder, exist_ok=True)
-            images = []
-            for search_term in search_terms:
-                images += get_images(query=search_term, output_folder=images_folder, amount=1)
-
-            assert len(images) > 0, "No images found"
-
-            audio_path = os.path.join(output_folder, "audio.mp3")
-            voice_name = "en-US-AndrewNeural-Male" if _language == "english" else "vi-VN-NamMinhNeural"
-            subtitle_output_file, audio_duration = create_voice_and_subtitle(
-                voice_name=voice_name,
-                text=story["moral"] + "\n" + story["story"],
-                voice_output_file=audio_path,
-                voice_rate=_voice_rate,
+            video_width, video_height = VideoAspect(params.video_aspect).to_resolution()
+            images = acquire_images(
+                search_terms,
+                images_folder,
+                total=math.ceil(audio_duration / _max_image_duration),
+                video_width=video_width,
+                video_height=video_height,
             )
 
-            output_video_folder = os.path.join(output_folder, "videos")
-            os.makedirs(output_video_folder, exist_ok=True)
-            for image_path in images:
-                video_path = os.path.join(output_video_folder, f"video-{os.path.basename(image_path)}.mp4")
-                image2video(image_path, video_path, audio_duration / len(images))
-
-            video_path = combine_videos(
-                os.path.join(output_folder, "video.mp4"),
-                glob.glob(os.path.join(output_video_folder, "*")),
-                audio_path,
-                max_clip_duration=audio_duration / len(images),
-            )
+            assert len(images) > 0, "No images found"
 
             final_video_path = os.path.join(output_folder, "video-final.mp4")
-            generate_video(
-                video_path=video_path,
-                audio_path=audio_path,
-                subtitle_path=subtitle_output_file,
-                output_file=final_video_path,
-                params=VideoParams(),
-            )
+            if params.render_mode == "single_pass":
+                final_video_path = generate_video_from_images(
+                    image_paths=images,
+                    audio_path=audio_path,
+                    subtitle_path=subtitle_output_file,
+                    output_file=final_video_path,
+                    params=params,
+                    audio_duration=audio_duration,
+                )
+                assert final_video_path, "Cannot render video"
+            elif params.render_mode == "segmented":
+                final_video_path = generate_video_segmented(
+                    image_paths=images,
+                    audio_path=audio_path,
+                    subtitle_path=subtitle_output_file,
+                    output_file=final_video_path,
+                    params=params,
+                    clip_duration=audio_duration / len(images),
+                )
+                assert final_video_path, "Cannot render video"
+            else:
+                output_video_folder = os.path.join(output_folder, "videos")
+                videos, _ = render_clips(images, output_video_folder, audio_duration / len(images))
+                assert len(videos) > 0, "No clips rendered"
+
+                video_path = combine_videos(
+                    os.path.join(output_folder, "video.mp4"),
+                    videos,
+                    audio_path,
+                    max_clip_duration=audio_duration / len(images),
+                )
+
+                generate_video(
+                    video_path=video_path,
+                    audio_path=audio_path,
+                    subtitle_path=subtitle_output_file,
+                    output_file=final_video_path,
+                    params=params,
+                )
 
             logger.success(f"Task {task_id} completed!")
 
@@ -1,14 +1,26 @@
 import os
 import requests
 import urllib.parse
-import json
 from rich.progress import track
 import math
-import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from uuid import uuid4
 
 import cv2
 import numpy as np
 from loguru import logger
+from moviepy import VideoClip
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from app import config
+from app.core import retry, utils
+from app.core.assets import get_asset_store
+from app.core.ffmpeg import open_rawvideo_writer
+from app.core.rate_limit import get_pexels_bucket
 
 # Replace with your actual API key
 
@@ -16,10 +28,203 @@ from loguru import logger
 API_KEY = os.getenv("PEXELS_API_KEY")
 BASE_URL = "https://api.pexels.com/v1/search"
 
+_frame_engine = config["video"].get("frame_engine", "opencv")  # opencv, ffmpeg
+_video_codec = config["video"].get("video_codec", "libx264")
+_frame_batch_size = config["video"].get("frame_batch_size", 25)
+_render_workers = config["video"].get("render_workers", 0)  # 0 means one worker per CPU
+_max_connections = config.get("pexels", {}).get("max_connections", 8)
+_dedup_threshold = config.get("pexels", {}).get("dedup_threshold", 10)
+_min_aspect = config.get("pexels", {}).get("min_aspect", 0.5)
+_max_aspect = config.get("pexels", {}).get("max_aspect", 1.0)
+_max_upscale = config.get("pexels", {}).get("max_upscale", 1.0)
+_per_page = 5  # Search results are cached, so always fetch as many as any caller uses
+
+
+def _rendition_size(url: str, photo_width: int, photo_height: int) -> tuple:
+    # Rendition URLs carry the resize parameters, e.g. "...jpeg?auto=compress&cs=tinysrgb&dpr=2&h=650&w=940"
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    if query.get("fit", [""])[0] == "crop":
+        # Cropped renditions change the framing of the photo
+        return 0, 0
+
+    dpr = float(query.get("dpr", [1])[0])
+    scales = []
+    if "w" in query:
+        scales.append(float(query["w"][0]) / photo_width)
+    if "h" in query:
+        scales.append(float(query["h"][0]) / photo_height)
+    if not scales:
+        return photo_width, photo_height
+
+    # Renditions are never upscaled
+    scale = min(1.0, min(scales) * dpr)
+    return int(photo_width * scale), int(photo_height * scale)
+
+
+def _sized_url(url: str, **size) -> str:
+    # Pexels resizes any photo on the fly, keeping its aspect ratio when only one side is given
+    separator = "&" if urllib.parse.urlparse(url).query else "?"
+    return f"{url}{separator}{urllib.parse.urlencode({'auto': 'compress', 'cs': 'tinysrgb', **size})}"
+
+
+def pick_rendition(photo: dict, video_width: int = 1080, video_height: int = 1920) -> str:
+    """Picks the smallest rendition of a Pexels photo that still covers the video frame.
+
+    The fixed renditions in the search response are too small for a full HD frame, so the
+    original is requested resized to the side that covers the frame.
+
+    Args:
+        photo (dict): A photo from the Pexels search response.
+        video_width (int, optional): Width of the video. Defaults to 1080.
+        video_height (int, optional): Height of the video. Defaults to 1920.
+
+    Returns:
+        str: URL of the rendition, the original photo if no smaller rendition covers the frame.
+    """
+    src = photo["src"]
+    photo_width, photo_height = photo.get("width", 0), photo.get("height", 0)
+    if not (photo_width and photo_height):
+        return src["original"]
+
+    # Size of the photo once scaled to cover the frame; the pan only crops inside it, so no extra margin is needed
+    scale = max(video_width / photo_width, video_height / photo_height)
+    min_width, min_height = photo_width * scale, photo_height * scale
+
+    if scale >= 1:
+        # The original is already no larger than the frame
+        return src["original"]
+
+    if video_width / photo_width >= video_height / photo_height:
+        candidates = [_sized_url(src["original"], w=video_width)]
+    else:
+        candidates = [_sized_url(src["original"], h=video_height)]
+    candidates += [url for name, url in src.items() if name != "original"]
+
+    best_url, best_pixels = src["original"], photo_width * photo_height
+    for url in candidates:
+        width, height = _rendition_size(url, photo_width, photo_height)
+        if width >= min_width - 1 and height >= min_height - 1 and width * height < best_pixels:
+            best_url, best_pixels = url, width * height
+    return best_url
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    """Returns a keep-alive session shared by the threads of this process, created after any fork."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_max_connections)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _search_request(url: str, timeout: float = None) -> requests.Response:
+    # Queue behind the shared rate limit instead of being throttled by Pexels
+    bucket = get_pexels_bucket()
+    bucket.acquire()
+    response = _get_session().get(url, headers={"Authorization": API_KEY}, timeout=timeout)
+    bucket.observe(response.headers)
+    response.raise_for_status()
+    return response
+
+
+def _get_to_file(url: str, output_file: str, timeout: float = None):
+    # Stream the body to disk instead of holding the whole image in memory
+    with _get_session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        with open(output_file, "wb") as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+
+
+def _search(query: str, orientation: str) -> list:
+    store = get_asset_store()
+    if store is not None:
+        photos = store.get_query(query, orientation)
+        if photos is not None:
+            logger.info(f"Using {len(photos)} cached search results for '{query}'")
+            return photos
+
+    # Encode the query to be URL-safe
+    encoded_query = urllib.parse.quote(query)
+    url = f"{BASE_URL}?query={encoded_query}&orientation={orientation}&per_page={_per_page}"
+
+    response = retry.call(_search_request, url, name="pexels", timeout=retry.http_timeout)
+    logger.info("Fetching images successfully.")
+    photos = response.json().get("photos", [])
+    if store is not None:
+        store.put_query(query, orientation, photos)
+    return photos
+
+
+def rank_photos(photos: list, video_width: int = 1080, video_height: int = 1920) -> list:
+    """Orders Pexels search results by how well they fit the frame, using only the sizes in the response.
+
+    Photos with an aspect ratio outside `pexels.min_aspect`..`pexels.max_aspect`, or that need more
+    than `pexels.max_upscale` to cover the frame, are dropped. Photos that cover the frame without
+    upscaling come first, otherwise the search relevance order is kept.
+
+    Returns:
+        list: The photos worth downloading, best first.
+    """
+    ranked = []
+    for position, photo in enumerate(photos):
+        photo_width, photo_height = photo.get("width", 0), photo.get("height", 0)
+        if not (photo_width and photo_height):
+            ranked.append((1, position, photo))
+            continue
+
+        aspect = photo_width / photo_height
+        upscale = max(video_width / photo_width, video_height / photo_height)
+        if not _min_aspect <= aspect <= _max_aspect or upscale > _max_upscale:
+            logger.debug(f"Skipping photo {photo.get('id')} of {photo_width} x {photo_height}, it would render badly")
+            continue
+        ranked.append((0 if upscale <= 1 else 1, position, photo))
+
+    return [photo for _, _, photo in sorted(ranked, key=lambda item: item[:2])]
+
+
+def _download(photo: dict, output_folder: str, idx: int) -> str:
+    photo_url = pick_rendition(photo)
+    photo_id = photo.get("id", f"NoID_{idx}")
+    filename = os.path.join(output_folder, f"{photo_id}.jpg")
+
+    store = get_asset_store()
+    if store is not None:
+        stored_file = store.get_photo(photo_id, photo_url)
+        if stored_file:
+            try:
+                return store.link(stored_file, filename)
+            except FileNotFoundError:
+                # Another process evicted the file after it was looked up
+                logger.info(f"Stored image of photo {photo_id} was evicted meanwhile, downloading it again")
+
+    # Download next to the destination and move it in place once complete, so no one sees a partial file
+    download_file = os.path.join(store.path if store is not None else output_folder, f"{uuid4()}.part")
+    try:
+        retry.call(_get_to_file, photo_url, download_file, name="pexels", timeout=retry.http_timeout)
+    except BaseException:
+        if os.path.exists(download_file):
+            os.remove(download_file)
+        raise
+
+    if store is None:
+        os.replace(download_file, filename)
+        return filename
+    return store.link(store.put_photo(photo_id, photo_url, download_file), filename)
+
 
 def get_images(query: str, output_folder: str, orientation: str = "portrait", amount: int = 5) -> list:
     """Fetches images from Pexels API and saves them to the output folder.
 
+    Search results and images are served from the shared image store when it has them.
+
     Args:
         query (str): The search term for images.
         output_folder (str): Directory to save downloaded images.
@@ -32,113 +237,367 @@ def get_images(query: str, output_folder: str, orientation: str = "portrait", am
     logger.info(f"\n\n## Fetching images from Pexels\n## query: '{query}'\n## amount: {amount}\n## orientation: {orientation}")
     os.makedirs(output_folder, exist_ok=True)
 
-    # Encode the query to be URL-safe
-    encoded_query = urllib.parse.quote(query)
-    url = f"{BASE_URL}?query={encoded_query}&orientation={orientation}&per_page={min(amount, 5)}"
-
-    headers = {"Authorization": API_KEY}
-
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Raise an error for bad responses
-        logger.info("Fetching images successfully.")
-
-        data = response.json()
-        photos = data.get("photos", [])
+        photos = rank_photos(_search(query, orientation))[:amount]
         logger.info(f"Saving {len(photos)} images to {output_folder}")
 
         saved_files = []
         for idx, photo in enumerate(photos):
-            photo_url = photo["src"]["original"]
-            photo_id = photo.get("id", f"NoID_{idx}")
-
-            img_response = requests.get(photo_url)
-            img_response.raise_for_status()  # Check if the image was retrieved successfully
-
-            filename = os.path.join(output_folder, f"{photo_id}.jpg")
-
-            with open(filename, "wb") as f:
-                f.write(img_response.content)
-
-            saved_files.append(filename)
+            saved_files.append(_download(photo, output_folder, idx))
 
         logger.info(f"Successfully downloaded {len(saved_files)} images to {output_folder}")
-        if len(saved_files) > amount:
-            saved_files = random.choices(saved_files, k=amount)
         return saved_files
 
-    except requests.RequestException as e:
+    except Exception as e:
         logger.error(f"Error fetching images: {e}")
         return []
 
 
-def image2video(image_path: str, output_video_path: str, duration: float):
-    max_attemp = 3
-    while max_attemp > 0:
-        try:
-            logger.info(f"Generating video from image: {image_path}")
+def _dct_matrix(size: int) -> np.ndarray:
+    n = np.arange(size)
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def perceptual_hash(image_path: str) -> Optional[int]:
+    """Computes a 64-bit DCT perceptual hash of an image.
+
+    The image is shrunk to 32x32 grayscale, and each bit tells whether one of the 8x8 lowest
+    frequencies is above their median. Resized, recompressed or slightly edited copies of a
+    photo get hashes a few bits apart.
+
+    Returns:
+        Optional[int]: The hash, or None if the image cannot be read.
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+    image = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = (_DCT_32 @ image @ _DCT_32.T)[:8, :8].flatten()
+    # The DC term is the average brightness, it is left out of the median
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _is_near_duplicate(phash: Optional[int], hashes: list) -> bool:
+    return phash is not None and any((phash ^ other).bit_count() <= _dedup_threshold for other in hashes)
+
+
+def _download_with_hash(photo: dict, output_folder: str, idx: int) -> tuple:
+    file_path = _download(photo, output_folder, idx)
+    photo_id = photo.get("id")
+
+    store = get_asset_store()
+    phash = store.get_hash(photo_id) if store is not None and photo_id else None
+    if phash is None:
+        phash = perceptual_hash(file_path)
+        if phash is not None and store is not None and photo_id:
+            store.set_hash(photo_id, phash)
+    return file_path, phash
+
+
+def acquire_images(
+    search_terms: List[str],
+    output_folder: str,
+    orientation: str = "portrait",
+    amount: int = 1,
+    total: int = 0,
+    video_width: int = 1080,
+    video_height: int = 1920,
+) -> list:
+    """Fetches images for all search terms at once, over a shared pool of keep-alive connections.
+
+    Searches run concurrently, then the downloads of every term, at most `pexels.max_connections`
+    requests at a time. Only the results that fit the frame are downloaded, see `rank_photos`.
+    Near-duplicate photos, within `pexels.dedup_threshold` bits of perceptual hash, are kept once:
+    photos whose hash is already in the image store are skipped before the download, the others are
+    dropped after it. A dropped or failed photo is replaced by the term's next result.
+
+    Args:
+        search_terms (List[str]): The search terms.
+        output_folder (str): Directory to save downloaded images.
+        orientation (str, optional): Image orientation. Defaults to "portrait".
+        amount (int, optional): Number of images per search term. Defaults to 1. Ignored if `total` is set.
+        total (int, optional): Number of images in all, spread evenly over the search terms. Defaults to 0.
+        video_width (int, optional): Width of the video. Defaults to 1080.
+        video_height (int, optional): Height of the video. Defaults to 1920.
 
-            # Load the image
-            image = cv2.imread(image_path)
+    Returns:
+        list: The saved image file paths, grouped by search term in order.
+    """
+    needed = total or amount * len(search_terms)
+    logger.info(f"Fetching {needed} images for search terms: {search_terms}")
+    os.makedirs(output_folder, exist_ok=True)
+    store = get_asset_store()
+
+    def submit(executor, func, *args):
+        # Each task gets its own copy of the context, so the retry budget reaches the worker threads
+        return executor.submit(contextvars.copy_context().run, func, *args)
+
+    with ThreadPoolExecutor(max_workers=_max_connections) as executor:
+        searches = [submit(executor, _search, term, orientation) for term in search_terms]
+
+        candidates = []
+        for term, future in zip(search_terms, searches):
+            try:
+                candidates.append(rank_photos(future.result(), video_width, video_height))
+            except Exception as e:
+                logger.error(f"Error searching images for '{term}': {e}")
+                candidates.append([])
+
+        selected = [[] for _ in search_terms]
+        next_candidate = [0] * len(search_terms)
+        seen_ids = set()
+        hashes = []
+
+        def pop_candidate(term_idx: int) -> Optional[dict]:
+            photos = candidates[term_idx]
+            while next_candidate[term_idx] < len(photos):
+                photo = photos[next_candidate[term_idx]]
+                next_candidate[term_idx] += 1
+                photo_id = photo.get("id")
+                if photo_id is not None and photo_id in seen_ids:
+                    continue
+                seen_ids.add(photo_id)
+                if store is not None and photo_id is not None and _is_near_duplicate(store.get_hash(photo_id), hashes):
+                    logger.info(f"Skipping photo {photo_id}, a near-duplicate of an image already fetched")
+                    continue
+                return photo
+            return None
+
+        idx = 0
+        while True:
+            # Download only what is still missing, taking turns between the terms with the fewest images
+            shortfall = needed - sum(len(files) for files in selected)
+            pending = [0] * len(search_terms)
+            batch = []
+            while len(batch) < shortfall:
+                added = False
+                for term_idx in sorted(range(len(search_terms)), key=lambda i: len(selected[i]) + pending[i]):
+                    if len(batch) >= shortfall:
+                        break
+                    if not total and len(selected[term_idx]) + pending[term_idx] >= amount:
+                        continue
+                    photo = pop_candidate(term_idx)
+                    if photo is None:
+                        continue
+                    batch.append((term_idx, submit(executor, _download_with_hash, photo, output_folder, idx)))
+                    pending[term_idx] += 1
+                    idx += 1
+                    added = True
+                if not added:
+                    break
+            if not batch:
+                break
+
+            for term_idx, future in batch:
+                try:
+                    file_path, phash = future.result()
+                except Exception as e:
+                    logger.error(f"Error downloading image: {e}")
+                    continue
+                if _is_near_duplicate(phash, hashes):
+                    logger.info(f"Dropping {file_path}, a near-duplicate of an image already fetched")
+                    os.remove(file_path)
+                    continue
+                if phash is not None:
+                    hashes.append(phash)
+                selected[term_idx].append(file_path)
+
+    saved_files = [file_path for files in selected for file_path in files]
+    logger.info(f"Successfully fetched {len(saved_files)} images to {output_folder}")
+    return saved_files
+
+
+def _reduced_imread_flag(image_path: str, video_width: int, video_height: int) -> int:
+    try:
+        with Image.open(image_path) as img:
+            img_width, img_height = img.size
+    except Exception:
+        return cv2.IMREAD_COLOR
+
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if img_width // factor >= video_width and img_height // factor >= video_height:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def _load_pan_image(image_path: str, video_width: int, video_height: int):
+    """Loads, darkens and resizes an image so it covers the video frame.
+
+    Returns:
+        tuple: The resized BGR image, the initial crop offsets (x, y) and the maximum translation in pixels.
+    """
+    # Load the image, decoding JPEGs at a reduced size when that still covers the frame
+    image = cv2.imread(image_path, _reduced_imread_flag(image_path, video_width, video_height))
+
+    black = np.zeros_like(image, dtype=np.uint8)
+    image = cv2.addWeighted(image, 0.6, black, 0.4, 0.0)
+    # brightness_reduction = 20
+    # image = cv2.subtract(image, np.full(image.shape, brightness_reduction, dtype=np.uint8))
+
+    # Resize image while maintaining aspect ratio (fill 1080x1920)
+    img_height, img_width = image.shape[:2]
+    if img_width / img_height < 9 / 16:
+        logger.warning(f"The image size is {img_width} x {img_height} may cause the video looks unusual")
+
+    scale = max(video_width / img_width, video_height / img_height)  # Scale to cover
+    new_width, new_height = int(img_width * scale), int(img_height * scale)
+    resized_image = cv2.resize(image, (new_width, new_height))
+
+    diff = min(720, max(new_width - video_width, new_height - video_height))
+    # diff = new_width - video_width - 1
+    x_crop_start = max(0, (new_width - video_width - diff) // 2 - 1)
+    y_crop_start = 0
+
+    return resized_image, x_crop_start, y_crop_start, diff
+
+
+def _pan_offsets(num_frames: int, x_crop_start: int, y_crop_start: int, diff: int, max_x: int, max_y: int):
+    """Computes the crop offsets of every frame at once.
+
+    Returns:
+        tuple: Two int arrays of length `num_frames` with the x and y crop positions.
+    """
+    # Same as int((diff * i) / num_frames) in the frame loop, without the float round trip
+    translation = (diff * np.arange(num_frames, dtype=np.int64)) // num_frames
+    x_pos = np.clip(x_crop_start + translation, 0, max_x)
+    y_pos = np.clip(y_crop_start + translation, 0, max_y)
+    return x_pos, y_pos
+
+
+def _write_frames_opencv(resized_image, output_video_path: str, x_pos, y_pos, fps: int, video_width: int, video_height: int):
+    # Video writer
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    out = cv2.VideoWriter(output_video_path, fourcc, fps, (video_width, video_height))
+
+    for x, y in track(zip(x_pos, y_pos), total=len(x_pos), description="Generating video"):
+        # Crop translated frame from resized image
+        frame = resized_image[y : y + video_height, x : x + video_width]
+
+        # Write frame to video
+        out.write(frame)
+
+    # Release video writer
+    out.release()
 
-            black = np.zeros_like(image, dtype=np.uint8)
-            image = cv2.addWeighted(image, 0.6, black, 0.4, 0.0)
-            # brightness_reduction = 20
-            # image = cv2.subtract(image, np.full(image.shape, brightness_reduction, dtype=np.uint8))
 
-            # Define video resolution (1080x1920)
-            video_width, video_height = 1080, 1920
-            fps = 25  # Frames per second
-            num_frames = math.ceil(fps * duration)
+def _write_frames_ffmpeg(resized_image, output_video_path: str, x_pos, y_pos, fps: int, video_width: int, video_height: int):
+    # Every possible crop of the image as a zero-copy view, so a whole batch is gathered with one fancy index
+    windows = np.lib.stride_tricks.sliding_window_view(resized_image, (video_height, video_width, 3))
 
-            # Resize image while maintaining aspect ratio (fill 1080x1920)
-            img_height, img_width = image.shape[:2]
-            if img_width / img_height < 9 / 16:
-                logger.warning(f"The image size is {img_width} x {img_height} may cause the video looks unusual")
+    process = open_rawvideo_writer(output_video_path, video_width, video_height, fps, codec=_video_codec)
+    try:
+        for start in range(0, len(x_pos), _frame_batch_size):
+            batch = windows[y_pos[start : start + _frame_batch_size], x_pos[start : start + _frame_batch_size], 0]
+            process.stdin.write(batch.tobytes())
+    except BrokenPipeError:
+        pass
+
+    # communicate() closes stdin itself, and ffmpeg's error is reported below
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode('utf-8', errors='ignore').strip()}")
+
+
+def image2video(image_path: str, output_video_path: str, duration: float, frame_engine: str = "") -> str:
+    """Renders a pan video from an image. Raises if the video cannot be generated.
+
+    Returns:
+        str: The output video path.
+    """
+    frame_engine = frame_engine or _frame_engine
+    logger.info(f"Generating video from image: {image_path}")
 
-            scale = max(video_width / img_width, video_height / img_height)  # Scale to cover
-            new_width, new_height = int(img_width * scale), int(img_height * scale)
-            resized_image = cv2.resize(image, (new_width, new_height))
+    # Define video resolution (1080x1920)
+    video_width, video_height = 1080, 1920
+    fps = 25  # Frames per second
+    num_frames = math.ceil(fps * duration)
 
-            # Video writer
-            fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-            out = cv2.VideoWriter(output_video_path, fourcc, fps, (video_width, video_height))
+    resized_image, x_crop_start, y_crop_start, diff = _load_pan_image(image_path, video_width, video_height)
+    new_height, new_width = resized_image.shape[:2]
 
-            diff = min(720, max(new_width - video_width, new_height - video_height))
-            # diff = new_width - video_width - 1
-            x_crop_start = max(0, (new_width - video_width - diff) // 2 - 1)
-            y_crop_start = 0
+    x_pos, y_pos = _pan_offsets(num_frames, x_crop_start, y_crop_start, diff, new_width - video_width, new_height - video_height)
 
-            # print(new_width, video_width, diff)
-            # print(x_crop_start, y_crop_start)
+    if frame_engine == "ffmpeg":
+        _write_frames_ffmpeg(resized_image, output_video_path, x_pos, y_pos, fps, video_width, video_height)
+    else:
+        _write_frames_opencv(resized_image, output_video_path, x_pos, y_pos, fps, video_width, video_height)
 
-            # Translation settings
-            max_translation = diff  # Maximum translation in pixels
+    logger.info(f"Video saved as {output_video_path}")
+    return output_video_path
 
-            for i in track(range(num_frames), description="Generating video"):
-                # Compute translation offsets (move horizontally and vertically)
-                tx = int((max_translation * i) / num_frames)  # Move in x direction
-                ty = int((max_translation * i) / num_frames)  # Move in y direction
 
-                # Ensure image stays within bounds
-                x_pos = min(max(x_crop_start + tx, 0), new_width - video_width)
-                y_pos = min(max(y_crop_start + ty, 0), new_height - video_height)
+def render_clips(image_paths: list, output_folder: str, duration: float, max_workers: int = 0) -> tuple:
+    """Renders a pan video for every image in parallel.
+
+    Args:
+        image_paths (list): Images to render.
+        output_folder (str): Directory to save the videos.
+        duration (float): Duration of each video in seconds.
+        max_workers (int, optional): Size of the worker pool. Defaults to `video.render_workers`, or the number of CPUs.
+
+    Returns:
+        tuple: The rendered video paths, in the order of `image_paths`, and a dict mapping each failed image to its error.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    max_workers = max(1, min(max_workers or _render_workers or os.cpu_count() or 1, len(image_paths)))
 
-                # Crop translated frame from resized image
-                frame = resized_image[y_pos : y_pos + video_height, x_pos : x_pos + video_width]
+    executor = utils.create_pool_executor(max_workers)
+    logger.info(f"Rendering {len(image_paths)} clips with {max_workers} workers")
 
-                # Write frame to video
-                out.write(frame)
+    futures = {}
+    with executor:
+        for image_path in image_paths:
+            video_path = os.path.join(output_folder, f"video-{os.path.basename(image_path)}.mp4")
+            futures[image_path] = executor.submit(image2video, image_path, video_path, duration)
 
-            # Release video writer
-            out.release()
-            logger.info(f"Video saved as {output_video_path}")
-            return
+    videos = []
+    failures = {}
+    for image_path, future in futures.items():
+        try:
+            videos.append(future.result())
         except Exception as e:
-            logger.warning(f"Cannot generate video from image {image_path}. Attemp again")
-            max_attemp -= 1
+            logger.error(f"Generate video from image {image_path} failed: {e}")
+            failures[image_path] = str(e)
+
+    logger.info(f"Rendered {len(videos)} clips, {len(failures)} failed")
+    return videos, failures
+
+
+def image2clip(image_path: str, duration: float, video_width: int = 1080, video_height: int = 1920) -> VideoClip:
+    """Creates an in-memory pan clip from an image without encoding it to a file.
+
+    The clip applies the same pan as `image2video`, but frames are computed on demand,
+    so it can be composed into a larger timeline and encoded only once.
+
+    Args:
+        image_path (str): Path of the image.
+        duration (float): Duration of the clip in seconds.
+        video_width (int, optional): Width of the output frames. Defaults to 1080.
+        video_height (int, optional): Height of the output frames. Defaults to 1920.
+
+    Returns:
+        VideoClip: A clip producing RGB frames.
+    """
+    logger.info(f"Creating clip from image: {image_path}")
+
+    resized_image, x_crop_start, y_crop_start, diff = _load_pan_image(image_path, video_width, video_height)
+    resized_image = cv2.cvtColor(resized_image, cv2.COLOR_BGR2RGB)
+    new_height, new_width = resized_image.shape[:2]
+
+    def make_frame(t):
+        # Same translation as image2video, expressed in time instead of frame index
+        offset = int(diff * min(max(t / duration, 0), 1))
+        x_pos = min(max(x_crop_start + offset, 0), new_width - video_width)
+        y_pos = min(max(y_crop_start + offset, 0), new_height - video_height)
+        return resized_image[y_pos : y_pos + video_height, x_pos : x_pos + video_width]
 
-    logger.error(f"Generate video from image {image_path} failed!")
+    return VideoClip(make_frame, duration=duration)
 
 
 # Example usage
@@ -1,6 +1,8 @@
 from loguru import logger
 import requests
 
+from app.core import retry
+
 URL = "https://official-joke-api.appspot.com/random_joke"
 
 
@@ -11,7 +13,7 @@ def get_random_joke() -> dict:
         dict: The joke data containing 'setup' and 'punchline'.
     """
     try:
-        response = requests.get(URL)
+        response = requests.get(URL, timeout=retry.timeout_for(retry.http_timeout))
         response.raise_for_status()  # Raise an error for HTTP issues
 
         joke = response.json()
@@ -22,7 +24,7 @@ def get_random_joke() -> dict:
 
         return joke  # Return parsed JSON
 
-    except requests.RequestException as e:
+    except Exception as e:
         logger.error(f"Error fetching joke: {e}")
         return {}  # Return an empty dictionary in case of failure
 
@@ -1,72 +1,177 @@
+import asyncio
+import concurrent.futures
 import json
 import re
-from typing import List
+import threading
+import time
+from typing import AsyncIterator, List
 import traceback
 
-import g4f
 from loguru import logger
 
 from app import config
+from app.core import prompts, retry, utils
+from app.core.cache import get_cache, make_key
+from app.core.llm_providers import get_provider
+from app.core.models.schema import StoryBundle
 
 _max_retries = 3
 
 
+_model = config["llm"].get("model", "gpt-4o")
 _temperature = config["llm"].get("temperature", 1.0)
+_max_concurrency = config["llm"].get("max_concurrency", 4)
 _max_story_words = config["story"].get("max_words", 200)
 _language = config["video"].get("language", "English")
+_timeout = config["llm"].get("timeout", 120)
+_hedge_provider = config["llm"].get("hedge_provider", "")
+_hedge_delay = config["llm"].get("hedge_delay", 20.0)
 
 
-def _generate_response(prompt: str) -> str:
-    i = 0
+class _ProcessLimiter:
+    """Limits the requests running at once across every thread and event loop of the process.
 
-    while i < _max_retries:
-        try:
-            content = ""
-            logger.info(f"Using g4f as llm provider")
-            logger.info("=" * 100)
-            logger.info("prompt: " + prompt)
-
-            content = g4f.ChatCompletion.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=_temperature,
+    The sync wrappers run a new event loop per call, and asyncio primitives are bound to
+    one loop, so the slots are a threading semaphore polled without blocking the loop.
+    """
+
+    def __init__(self, value: int, poll_interval: float = 0.05):
+        self._semaphore = threading.BoundedSemaphore(value)
+        self._poll_interval = poll_interval
+
+    async def __aenter__(self):
+        while not self._semaphore.acquire(blocking=False):
+            await asyncio.sleep(self._poll_interval)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        return False
+
+
+_limiter = _ProcessLimiter(_max_concurrency)
+
+# In-flight requests by cache key. Thread-safe futures, so callers on any loop can join them.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+async def _acomplete(provider, prompt: str, purpose: str) -> str:
+    async with _limiter:
+        # The deadline starts once a slot is free, time spent queueing is not the provider's fault
+        start = time.perf_counter()
+        content = await asyncio.wait_for(provider.acomplete(prompt, purpose=purpose), retry.timeout_for(_timeout))
+    prompts.record_call(purpose, prompt, content, time.perf_counter() - start)
+    return content
+
+
+async def _acomplete_with_retry(provider, prompt: str, purpose: str) -> str:
+    return await retry.acall(_acomplete, provider, prompt, purpose, name=f"llm:{provider.name}")
+
+
+async def _request(prompt: str, purpose: str = "", keep_newlines: bool = False) -> str:
+    provider = get_provider()
+    logger.info(f"Sending a {purpose or 'generic'} prompt of ~{prompts.estimate_tokens(prompt)} tokens to {provider.name}")
+    logger.debug("prompt: " + prompt)
+
+    try:
+        if _hedge_provider and _hedge_provider != provider.name:
+            hedge = get_provider(_hedge_provider)
+            content = await retry.ahedged(
+                lambda: _acomplete_with_retry(provider, prompt, purpose),
+                lambda: _acomplete_with_retry(hedge, prompt, purpose),
+                delay=_hedge_delay,
             )
+        else:
+            content = await _acomplete_with_retry(provider, prompt, purpose)
+    except Exception as e:
+        logger.error(f"Cannot generate response: {e}")
+        return ""
+
+    logger.success("Successfully generate response from llm")
+    return content if keep_newlines else content.replace("\n", ". ")
+
+
+async def _agenerate_response(
+    prompt: str, purpose: str = "", use_cache: bool = False, refresh: bool = False, keep_newlines: bool = False
+) -> str:
+    """Sends a prompt to the LLM.
+
+    At most `llm.max_concurrency` requests run at once in the process, and identical
+    prompts in flight share one upstream request, across threads and event loops.
+
+    Args:
+        prompt (str): The prompt.
+        purpose (str, optional): What the response is used for, part of the cache key.
+        use_cache (bool, optional): Read and store the response in the LLM cache. Defaults to False.
+        refresh (bool, optional): Skip reading the cache but still store the new response,
+            e.g. when a cached response could not be parsed. Defaults to False.
+        keep_newlines (bool, optional): Return the response as is, e.g. for JSON. By default
+            newlines are replaced with ". ". Defaults to False.
+    """
+    cache = get_cache("llm") if use_cache else None
+    cache_key = make_key(prompt, get_provider().name, _model, _temperature, purpose)
+    if cache is not None and not refresh:
+        try:
+            content = cache.get(cache_key)
+            if content:
+                logger.info(f"Using cached llm response for {purpose or 'prompt'}")
+                return content
+        except Exception as e:
+            logger.warning(f"Cannot read llm cache: {e}")
 
-            logger.success(f"Successfully generate response from llm")
-            return content.replace("\n", ". ")
+    with _inflight_lock:
+        future = _inflight.get(cache_key)
+        joined = future is not None
+        if not joined:
+            future = concurrent.futures.Future()
+            _inflight[cache_key] = future
+
+    if joined:
+        logger.info(f"Joining an in-flight llm request for {purpose or 'prompt'}")
+    else:
+        task = asyncio.ensure_future(_request(prompt, purpose=purpose, keep_newlines=keep_newlines))
+
+        def settle(task: asyncio.Task):
+            with _inflight_lock:
+                _inflight.pop(cache_key, None)
+            # _request returns "" on failure, and so do the callers joined on it
+            future.set_result("" if task.cancelled() or task.exception() is not None else task.result())
+
+        task.add_done_callback(settle)
+
+    # Shield the shared request, so a cancelled caller does not cancel it for the others
+    content = await asyncio.shield(asyncio.wrap_future(future))
+
+    if cache is not None and content and "error: " not in content.lower():
+        try:
+            cache.set(cache_key, content)
         except Exception as e:
-            logger.error(f"Cannot generate response: {e}")
-            i += 1
-            logger.info(f"Retrying attemp #{i + 1}")
-
-    return ""
-
-
-def generate_script(video_subject: str, language: str = "", paragraph_number: int = 1) -> str:
-    prompt = f"""
-# Role: Video Script Generator
-
-## Goals:
-Generate a script to provide more informations that supports the subject of the video.
-
-## Constrains:
-1. the script is to be returned as a string with the specified number of paragraphs.
-2. do not under any circumstance reference this prompt in your response.
-3. get straight to the point, don't start with unnecessary things like, "welcome to this video".
-4. you must not include any type of markdown or formatting in the script, never use a title.
-5. only return the raw content of the script.
-6. do not include "voiceover", "narrator" or similar indicators of what should be spoken at the beginning of each paragraph or line.
-7. you must not mention the prompt, or anything about the script itself. also, never talk about the amount of paragraphs or lines. just write the script.
-8. respond in the same language as the video subject.
-9. the script must consist 80-100 words
-10. the scipt must start with "Did you know: {video_subject}"
-
-# Initialization:
-- video subject: {video_subject}
-- number of paragraphs: {paragraph_number}
-""".strip()
+            logger.warning(f"Cannot write llm cache: {e}")
+    return content
+
+
+def _generate_response(prompt: str, purpose: str = "", use_cache: bool = False, refresh: bool = False) -> str:
+    return asyncio.run(_agenerate_response(prompt, purpose=purpose, use_cache=use_cache, refresh=refresh))
+
+
+async def agenerate_script(video_subject: str, language: str = "", paragraph_number: int = 1, use_cache: bool = False) -> str:
+    initialization = f"- video subject: {video_subject}\n- number of paragraphs: {paragraph_number}"
     if language:
-        prompt += f"\n- language: {language}"
+        initialization += f"\n- language: {language}"
+    prompt = prompts.build_prompt(
+        role="Video Script Generator",
+        goal="Generate a script to provide more informations that supports the subject of the video.",
+        constraints=[
+            "the script is to be returned as a string with the specified number of paragraphs.",
+            'do not include "voiceover", "narrator" or similar indicators of what should be spoken at the beginning of each paragraph or line.',
+            "you must not mention anything about the script itself. also, never talk about the amount of paragraphs or lines. just write the script.",
+            "respond in the same language as the video subject.",
+            "the script must consist 80-100 words",
+            f'the scipt must start with "Did you know: {video_subject}"',
+        ],
+        sections={"Initialization": initialization},
+    )
 
     final_script = ""
     logger.info(f"subject: {video_subject}")
@@ -92,11 +197,13 @@ Generate a script to provide more informations that supports the subject of the
 
     for i in range(_max_retries):
         try:
-            response = _generate_response(prompt=prompt)
+            response = await _agenerate_response(prompt=prompt, purpose="script", use_cache=use_cache, refresh=i > 0)
             if response:
                 final_script = format_response(response)
             else:
+                # Transport errors have already been retried by _request
                 logger.error("gpt returned an empty response")
+                break
 
             # g4f may return an error message
             if final_script and "当日额度已消耗完" in final_script:
@@ -116,29 +223,23 @@ Generate a script to provide more informations that supports the subject of the
     return final_script.strip()
 
 
-def generate_terms(content: str, amount: int = 3) -> List[str]:
-    prompt = f"""
-# Role: Video Search Terms Generator
-
-## Goals:
-Generate {amount} search terms for searching images to tell the provided story.
-
-## Constrains:
-1. Return search terms as a JSON array of strings.
-2. The first term must be the story's main character. Each additional term (1-3 words) must include other characters or the place where the story happens.
-3. Only return the JSON array—nothing else, not the script.
-4. Search terms must closely relate to the story's characters or scene.
-5. Use English search terms only.
-6. Each term must be a concrete noun and must not be names of characters.
+def generate_script(video_subject: str, language: str = "", paragraph_number: int = 1, use_cache: bool = False) -> str:
+    return asyncio.run(agenerate_script(video_subject, language=language, paragraph_number=paragraph_number, use_cache=use_cache))
 
-## Output Example:
-["search term 1", "search term 2", "search term 3"]
 
-## The story:
-{content}
-
-Please note that you must use English for generating video search terms; Chinese is not accepted.
-""".strip()
+async def agenerate_terms(content: str, amount: int = 3, use_cache: bool = True) -> List[str]:
+    prompt = prompts.build_prompt(
+        role="Video Search Terms Generator",
+        goal=f"Generate {amount} search terms for searching images to tell the provided story.",
+        constraints=[
+            "Return search terms as a JSON array of strings, for example: [\"search term 1\", \"search term 2\", \"search term 3\"]",
+            "The first term must be the story's main character. Each additional term (1-3 words) must include other characters or the place where the story happens.",
+            "Search terms must closely relate to the story's characters or scene.",
+            "Use English search terms only; Chinese is not accepted.",
+            "Each term must be a concrete noun and must not be names of characters.",
+        ],
+        sections={"The story": content},
+    )
 
     # logger.info(f"subject: {video_subject}")
 
@@ -146,7 +247,7 @@ Please note that you must use English for generating video search terms; Chinese
     response = ""
     for i in range(_max_retries):
         try:
-            response = _generate_response(prompt)
+            response = await _agenerate_response(prompt, purpose="terms", use_cache=use_cache, refresh=i > 0)
             if "Error: " in response:
                 logger.error(f"failed to generate video script: {response}")
                 return []
@@ -179,57 +280,59 @@ Please note that you must use English for generating video search terms; Chinese
     return search_terms
 
 
-def generate_story_from_moral(moral: str, example: str = "") -> str:
-    prompt = f"""
-# Role: Short Story Generator
+def generate_terms(content: str, amount: int = 3, use_cache: bool = True) -> List[str]:
+    return asyncio.run(agenerate_terms(content, amount=amount, use_cache=use_cache))
 
-## Goal:
-Generate a short story that show the provided moral.
 
-## Constrains:
-1. the story is to be returned as a plain text.
-2. the story must have unexpected plots. The characters have to be animals.
-3. do not under any circumstance reference this prompt in your response.
-4. get straight to the point, don't start with unnecessary things like, "here is a story...".
-5. you must not include any type of markdown or formatting in the story, never use a title.
-6. only return the raw content of the story.
-7. you must not mention the prompt
-8. respond must in {_language}.
-9. the story must consist at most {_max_story_words} words
+def _story_prompt(moral: str, example: str = "") -> str:
+    return prompts.build_prompt(
+        role="Short Story Generator",
+        goal="Generate a short story that show the provided moral.",
+        constraints=[
+            "the story is to be returned as a plain text.",
+            "the story must have unexpected plots. The characters have to be animals.",
+            f"respond must in {_language}.",
+            f"the story must consist at most {_max_story_words} words",
+        ],
+        sections={"Moral": moral},
+        example=example,
+        example_title="Output Example",
+    )
 
-## Moral:
-{moral}
-"""
 
-    if example:
-        prompt += f"\n## Output Example:\n{example}"
+def _format_story(response):
+    # Clean the script
+    # Remove asterisks, hashes
+    response = response.replace("*", "")
+    response = response.replace("#", "")
 
-    def format_response(response):
-        # Clean the script
-        # Remove asterisks, hashes
-        response = response.replace("*", "")
-        response = response.replace("#", "")
+    # Remove markdown syntax
+    response = re.sub(r"\[.*\]", "", response)
+    response = re.sub(r"\(.*\)", "", response)
 
-        # Remove markdown syntax
-        response = re.sub(r"\[.*\]", "", response)
-        response = re.sub(r"\(.*\)", "", response)
+    # Split the script into paragraphs
+    paragraphs = response.split("\n\n")
 
-        # Split the script into paragraphs
-        paragraphs = response.split("\n\n")
+    # Select the specified number of paragraphs
+    # selected_paragraphs = paragraphs[:paragraph_number]
 
-        # Select the specified number of paragraphs
-        # selected_paragraphs = paragraphs[:paragraph_number]
+    # Join the selected paragraphs into a single string
+    return "\n\n".join(paragraphs)
 
-        # Join the selected paragraphs into a single string
-        return "\n\n".join(paragraphs)
 
+async def agenerate_story_from_moral(moral: str, example: str = "", use_cache: bool = False) -> str:
+    prompt = _story_prompt(moral, example)
+
+    final_story = ""
     for i in range(_max_retries):
         try:
-            response = _generate_response(prompt=prompt)
+            response = await _agenerate_response(prompt=prompt, purpose="story", use_cache=use_cache, refresh=i > 0)
             if response:
-                final_story = format_response(response)
+                final_story = _format_story(response)
             else:
+                # Transport errors have already been retried by _request
                 logger.error("gpt returned an empty response")
+                break
 
             # g4f may return an error message
             if final_story and "error:" in final_story.lower().strip():
@@ -252,32 +355,34 @@ Generate a short story that show the provided moral.
     return final_story.strip()
 
 
-def translate_to_vietnamese(content: str) -> str:
-    prompt = f"""
-# Role: Translator
-
-## Goals:
-Translate the provided paragraph to Vietnamese.
+def generate_story_from_moral(moral: str, example: str = "", use_cache: bool = False) -> str:
+    return asyncio.run(agenerate_story_from_moral(moral, example=example, use_cache=use_cache))
 
-## Constrains:
-1. the translation is always returned as a plain text.
-2. you must only return the translation. you must not return anything else.
-3. the translation must contain only vietnamese words.
 
-## Paragraph:
-{content}
-
-""".strip()
+async def atranslate_to_vietnamese(content: str, use_cache: bool = True) -> str:
+    prompt = prompts.build_prompt(
+        role="Translator",
+        goal="Translate the provided paragraph to Vietnamese.",
+        constraints=[
+            "the translation is always returned as a plain text.",
+            "you must only return the translation. you must not return anything else.",
+            "the translation must contain only vietnamese words.",
+        ],
+        sections={"Paragraph": content},
+    )
 
     # logger.info(f"subject: {video_subject}")
 
     response = ""
     for i in range(_max_retries):
         try:
-            response = _generate_response(prompt)
+            response = await _agenerate_response(prompt, purpose="translate", use_cache=use_cache, refresh=i > 0)
             if "Error: " in response:
                 logger.error(f"failed to translate: {response}")
                 return ""
+            if not response:
+                # Transport errors have already been retried by _request
+                break
 
             if not isinstance(response, str):
                 logger.error("response is not a string.")
@@ -296,6 +401,123 @@ Translate the provided paragraph to Vietnamese.
     return response
 
 
+def translate_to_vietnamese(content: str, use_cache: bool = True) -> str:
+    return asyncio.run(atranslate_to_vietnamese(content, use_cache=use_cache))
+
+
+async def astream_story_sentences(moral: str, example: str = "") -> AsyncIterator[str]:
+    """Generates a story from a moral and yields its sentences as soon as each one is complete.
+
+    Raises if the stream fails, so the caller can fall back to the non-streaming path.
+    """
+    provider = get_provider()
+    prompt = _story_prompt(moral, example)
+    logger.info(f"Streaming a story from {provider.name} with a prompt of ~{prompts.estimate_tokens(prompt)} tokens")
+    logger.debug("prompt: " + prompt)
+
+    buffer = ""
+    chunks = []
+    async with _limiter, retry.guard(f"llm:{provider.name}"):
+        start = time.perf_counter()
+        async for chunk in retry.aiter_with_timeout(provider.astream(prompt, purpose="story"), _timeout):
+            buffer += chunk
+            chunks.append(chunk)
+            sentences, buffer = utils.split_complete_sentences(buffer)
+            for sentence in sentences:
+                sentence = _format_story(sentence).strip()
+                if sentence:
+                    yield sentence
+
+    prompts.record_call("story", prompt, "".join(chunks), time.perf_counter() - start)
+
+    sentence = _format_story(buffer).strip()
+    if sentence:
+        yield sentence
+    logger.success(f"A story for moral '{moral}' has been streamed")
+
+
+def _parse_story_bundle(response: str) -> StoryBundle:
+    try:
+        data = json.loads(response)
+    except json.JSONDecodeError:
+        match = re.search(r"\{.*\}", response, re.DOTALL)
+        if not match:
+            raise
+        data = json.loads(match.group())
+
+    bundle = StoryBundle(**data)
+    bundle.story = bundle.story.replace("*", "").replace("#", "").strip()
+    bundle.search_terms = [term.strip() for term in bundle.search_terms if term.strip()]
+    return bundle
+
+
+async def agenerate_story_bundle(moral: str, example: str = "", amount: int = 5, use_cache: bool = False) -> dict:
+    """Generates the story, its image search terms and the translated moral with a single LLM call.
+
+    Any field missing from the response is filled in with the individual calls.
+
+    Returns:
+        dict: `moral` (translated to the video language), `story` and `search_terms`.
+    """
+    prompt = prompts.build_prompt(
+        role="Short Story Generator",
+        goal=f"Generate a short story that show the provided moral, the image search terms to illustrate it, and the moral translated to {_language}.",
+        constraints=[
+            'Return a single JSON object with exactly these keys: "moral_translated", "story", "search_terms". Return nothing else.',
+            f'"moral_translated": the moral translated to {_language}, as plain text.',
+            f'"story": the story as plain text, in {_language}, at most {_max_story_words} words, without markdown or a title.',
+            "the story must have unexpected plots. The characters have to be animals.",
+            f'"search_terms": a JSON array of {amount} English search terms. The first term must be the story\'s main character. Each additional term (1-3 words) must include other characters or the place where the story happens.',
+            "Each search term must be a concrete noun and must not be names of characters.",
+        ],
+        sections={
+            "Output Example": '{"moral_translated": "...", "story": "...", "search_terms": ["search term 1", "search term 2", "search term 3"]}',
+            "Moral": moral,
+        },
+        example=example,
+        example_title="Story Example",
+    )
+
+    bundle = StoryBundle()
+    for i in range(_max_retries):
+        try:
+            response = await _agenerate_response(prompt, purpose="bundle", use_cache=use_cache, refresh=i > 0, keep_newlines=True)
+            if not response:
+                # Transport errors have already been retried by _request
+                logger.error("failed to generate story bundle: empty response")
+                break
+            if "error: " in response.lower():
+                logger.error(f"failed to generate story bundle: {response}")
+                continue
+            bundle = _parse_story_bundle(response)
+            break
+        except Exception as e:
+            logger.warning(f"failed to parse story bundle: {e}")
+
+        if i < _max_retries:
+            logger.warning(f"failed to generate story bundle, trying again... {i + 1}")
+
+    # Fall back to the individual calls for whatever is missing
+    if _language.lower().strip() != "vietnamese":
+        bundle.moral_translated = moral
+    if not bundle.moral_translated:
+        logger.warning("story bundle has no translated moral, translating it separately")
+        bundle.moral_translated = await atranslate_to_vietnamese(moral)
+    if not bundle.story:
+        logger.warning("story bundle has no story, generating it separately")
+        bundle.story = await agenerate_story_from_moral(moral, example=example)
+    if not bundle.search_terms and bundle.story:
+        logger.warning("story bundle has no search terms, generating them separately")
+        bundle.search_terms = await agenerate_terms(bundle.story, amount=amount)
+
+    logger.success(f"A story bundle for moral '{moral}' has been generated")
+    return {"moral": bundle.moral_translated, "story": bundle.story, "search_terms": bundle.search_terms}
+
+
+def generate_story_bundle(moral: str, example: str = "", amount: int = 5, use_cache: bool = False) -> dict:
+    return asyncio.run(agenerate_story_bundle(moral, example=example, amount=amount, use_cache=use_cache))
+
+
 if __name__ == "__main__":
     response = _generate_response(
         """
@@ -0,0 +1,154 @@
+import abc
+import asyncio
+import hashlib
+import inspect
+import json
+import random
+from typing import AsyncIterator
+
+import g4f
+from g4f.client import AsyncClient
+from loguru import logger
+
+from app import config
+
+_llm_config = config["llm"]
+
+
+class LLMProvider(abc.ABC):
+    name = ""
+
+    @abc.abstractmethod
+    async def acomplete(self, prompt: str, purpose: str = "") -> str:
+        """Returns the raw completion of a prompt. Raises on failure."""
+
+    async def astream(self, prompt: str, purpose: str = "") -> AsyncIterator[str]:
+        """Yields the completion of a prompt in chunks as they arrive. Raises on failure.
+
+        Providers without streaming yield the whole completion as a single chunk.
+        """
+        yield await self.acomplete(prompt, purpose=purpose)
+
+
+class G4FProvider(LLMProvider):
+    name = "g4f"
+
+    def __init__(self, model: str, temperature: float):
+        self.model = model
+        self.temperature = temperature
+
+    async def acomplete(self, prompt: str, purpose: str = "") -> str:
+        return await g4f.ChatCompletion.create_async(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=self.temperature,
+        )
+
+    async def astream(self, prompt: str, purpose: str = "") -> AsyncIterator[str]:
+        response = AsyncClient().chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=self.temperature,
+            stream=True,
+        )
+        if inspect.isawaitable(response):
+            response = await response
+        async for chunk in response:
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                yield content
+
+
+_OFFLINE_STORIES = {
+    "english": [
+        "A young fox boasted that he could cross the river faster than anyone. The old turtle said nothing and kept building a raft. "
+        "When the storm came, the fox was stuck on the bank while the turtle floated his friends to safety.",
+        "A proud peacock refused to share the shade of his tree with a tired sparrow. When the hunter came, "
+        "the sparrow's warning song was the only thing that saved him.",
+    ],
+    "vietnamese": [
+        "Chú cáo nhỏ luôn khoe rằng mình qua sông nhanh nhất khu rừng. Bác rùa già không nói gì, chỉ lặng lẽ đóng một chiếc bè. "
+        "Khi cơn bão đến, cáo mắc kẹt bên bờ, còn bác rùa đưa cả đàn bạn qua sông an toàn.",
+        "Chú công kiêu ngạo không cho chim sẻ mệt mỏi trú dưới bóng cây. Khi người thợ săn đến, "
+        "chính tiếng hót cảnh báo của chim sẻ đã cứu chú công.",
+    ],
+}
+_OFFLINE_TERMS = [
+    ["fox", "turtle", "river", "forest", "raft"],
+    ["peacock", "sparrow", "tree", "hunter", "meadow"],
+]
+
+
+class OfflineProvider(LLMProvider):
+    """A deterministic stand-in for load tests and benchmarks without the network.
+
+    Responses are canned and chosen by a hash of the prompt, so the same prompt always
+    gets the same response. `latency` seconds are added to every call, and a seeded
+    `failure_rate` of calls raise, to exercise the retry paths.
+    """
+
+    name = "offline"
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0, language: str = "English"):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.language = language.lower().strip()
+
+    def _complete(self, prompt: str, purpose: str) -> str:
+        if self.random.random() < self.failure_rate:
+            raise RuntimeError("Injected offline provider failure")
+
+        index = int(hashlib.md5(prompt.encode("utf-8")).hexdigest(), 16) % len(_OFFLINE_TERMS)
+        story = _OFFLINE_STORIES.get(self.language, _OFFLINE_STORIES["english"])[index]
+
+        if purpose == "terms":
+            return json.dumps(_OFFLINE_TERMS[index])
+        if purpose == "translate":
+            return "Hãy luôn khiêm tốn và giúp đỡ người khác."
+        if purpose == "bundle":
+            return json.dumps(
+                {"moral_translated": "Hãy luôn khiêm tốn và giúp đỡ người khác.", "story": story, "search_terms": _OFFLINE_TERMS[index]},
+                ensure_ascii=False,
+            )
+        return story
+
+    async def acomplete(self, prompt: str, purpose: str = "") -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._complete(prompt, purpose)
+
+    async def astream(self, prompt: str, purpose: str = "") -> AsyncIterator[str]:
+        # Stream the canned completion word by word, spreading the latency over the chunks
+        words = self._complete(prompt, purpose).split(" ")
+        for i, word in enumerate(words):
+            if self.latency:
+                await asyncio.sleep(self.latency / len(words))
+            yield word if i == 0 else f" {word}"
+
+
+_providers = {}
+
+
+def get_provider(name: str = "") -> LLMProvider:
+    """Returns the provider called `name`, by default the one selected by `llm.provider` in config.yaml."""
+    name = name or _llm_config.get("provider", "g4f")
+    if name in _providers:
+        return _providers[name]
+
+    if name == "offline":
+        offline_config = _llm_config.get("offline", {})
+        provider = OfflineProvider(
+            latency=offline_config.get("latency", 0.0),
+            failure_rate=offline_config.get("failure_rate", 0.0),
+            seed=offline_config.get("seed", 0),
+            language=config["video"].get("language", "English"),
+        )
+    else:
+        if name != "g4f":
+            logger.warning(f"Unknown llm provider '{name}'. Using g4f")
+        provider = G4FProvider(model=_llm_config.get("model", "gpt-4o"), temperature=_llm_config.get("temperature", 1.0))
+
+    logger.info(f"Using {provider.name} as llm provider")
+    _providers[name] = provider
+    return provider
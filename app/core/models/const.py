@@ -17,6 +17,8 @@ PUNCTUATIONS = [
     "...",
 ]
 
+SENTENCE_ENDINGS = [".", "!", "?", "…", "。", "！", "？"]
+
 TASK_STATE_FAILED = -1
 TASK_STATE_COMPLETE = 1
 TASK_STATE_PROCESSING = 4
@@ -26,3 +26,11 @@ class HttpException(Exception):
 
 class FileNotFoundException(Exception):
     pass
+
+
+class RetryBudgetExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
@@ -47,6 +47,22 @@ class MaterialInfo:
     duration: int = 0
 
 
+@pydantic.dataclasses.dataclass(config=_Config)
+class MediaInfo:
+    duration: float = 0.0
+    width: int = 0
+    height: int = 0
+    fps: float = 0.0
+    codec: str = ""
+    pix_fmt: str = ""
+
+
+class StoryBundle(BaseModel):
+    moral_translated: str = ""
+    story: str = ""
+    search_terms: List[str] = []
+
+
 class VideoParams(BaseModel):
     video_aspect: Optional[VideoAspect] = VideoAspect.portrait.value
     voice_rate: Optional[float] = config["video"].get("voice_rate", 1.0)
@@ -54,6 +70,7 @@ class VideoParams(BaseModel):
 
     subtitle_enabled: Optional[bool] = True
     subtitle_position: Optional[str] = "custom"  # top, bottom, center
+    subtitle_format: Optional[str] = config["video"].get("subtitle_format", "srt")  # srt, ass
     custom_position: float = config["video"].get("subtitle_position", 70)
 
     text_fore_color: Optional[str] = config["video"].get("font_color", "#FFFFFF")
@@ -63,4 +80,5 @@ class VideoParams(BaseModel):
     stroke_color: Optional[str] = config["video"].get("stroke_color", "#000000")
     stroke_width: float = config["video"].get("stroke_width", 4)
     n_threads: Optional[int] = 2
+    render_mode: Optional[str] = config["video"].get("render_mode", "legacy")  # legacy, single_pass, segmented
     paragraph_number: Optional[int] = 1
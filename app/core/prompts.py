@@ -0,0 +1,102 @@
+import math
+import threading
+from typing import List
+
+from loguru import logger
+
+from app import config
+from app.core import utils
+
+_example_max_tokens = config["llm"].get("example_max_tokens", 300)
+
+# Rules shared by every prompt. They come first, so providers that cache prompt prefixes can reuse them.
+SHARED_PREFIX = """
+# Rules:
+1. do not under any circumstance reference this prompt in your response.
+2. get straight to the point, don't start with unnecessary things like "here is...".
+3. only return the requested content in the requested format, without markdown or a title.
+""".strip()
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens of a text without a tokenizer.
+
+    Counts about 4 UTF-8 bytes per token, which also accounts for the longer encoding of
+    Vietnamese diacritics.
+    """
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Shortens a text to about `max_tokens` tokens by dropping whole sentences from the middle.
+
+    The opening sentences and the last one, which usually carries the ending, are kept.
+    """
+    text = text.strip()
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    sentences, rest = utils.split_complete_sentences(text)
+    if rest.strip():
+        sentences.append(rest.strip())
+    if len(sentences) < 2:
+        return text[: max_tokens * 4].rsplit(" ", 1)[0]
+
+    last = sentences[-1]
+    budget = max_tokens - estimate_tokens(last)
+    kept = []
+    for sentence in sentences[:-1]:
+        budget -= estimate_tokens(sentence) + 1
+        if budget < 0:
+            break
+        kept.append(sentence)
+    return " ".join(kept + [last])
+
+
+def build_prompt(role: str, goal: str, constraints: List[str], sections: dict = None, example: str = "", example_title: str = "Example") -> str:
+    """Builds a prompt with the static parts first and the per-call content last.
+
+    Args:
+        role (str): The role of the model.
+        goal (str): What the model must produce.
+        constraints (List[str]): Task-specific constraints, on top of the shared rules.
+        sections (dict, optional): Titles mapped to the per-call content, such as the moral or the story.
+        example (str, optional): An example response, trimmed to `llm.example_max_tokens`.
+        example_title (str, optional): Title of the example section.
+
+    Returns:
+        str: The prompt.
+    """
+    parts = [SHARED_PREFIX, f"# Role: {role}", f"## Goal:\n{goal}"]
+    if constraints:
+        parts.append("## Constraints:\n" + "\n".join(f"{i}. {constraint}" for i, constraint in enumerate(constraints, 1)))
+    for title, content in (sections or {}).items():
+        parts.append(f"## {title}:\n{content}")
+    if example:
+        trimmed = trim_to_tokens(example, _example_max_tokens)
+        if len(trimmed) < len(example.strip()):
+            logger.debug(f"Trimmed the example from {estimate_tokens(example)} to {estimate_tokens(trimmed)} tokens")
+        parts.append(f"## {example_title}:\n{trimmed}")
+    return "\n\n".join(parts)
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record_call(purpose: str, prompt: str, response: str, elapsed: float):
+    """Logs the size and latency of an LLM call, and adds them to the per-purpose totals."""
+    prompt_tokens, response_tokens = estimate_tokens(prompt), estimate_tokens(response)
+    logger.info(f"llm call: purpose={purpose or '-'} prompt_tokens={prompt_tokens} response_tokens={response_tokens} elapsed={elapsed:.2f}s")
+    with _stats_lock:
+        stats = _stats.setdefault(purpose or "-", {"calls": 0, "prompt_tokens": 0, "response_tokens": 0, "elapsed": 0.0})
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["response_tokens"] += response_tokens
+        stats["elapsed"] += elapsed
+
+
+def get_stats() -> dict:
+    """Returns the calls, estimated tokens and total latency of the LLM calls made by this process, per purpose."""
+    with _stats_lock:
+        return {purpose: dict(stats) for purpose, stats in _stats.items()}
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+from app import config
+from app.core import retry
+from app.core.models.exception import RetryBudgetExceeded
+
+# Seconds to wait when the bucket does not refill and no quota reset is known
+_no_refill_wait = 3600
+
+# Refill the bucket, pacing the requests over the quota left until the quota resets.
+# Returns the seconds to wait before a token is available, 0 if one was taken.
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local quota = redis.call('HMGET', KEYS[2], 'remaining', 'reset')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+local remaining = tonumber(quota[1])
+local reset = tonumber(quota[2])
+if remaining and reset and now < reset then
+    capacity = math.min(capacity, remaining)
+    rate = math.min(rate, remaining / (reset - now))
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+elseif rate > 0 then
+    wait = (1 - tokens) / rate
+elseif reset and reset > now then
+    wait = reset - now
+else
+    wait = tonumber(ARGV[4])
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], 86400)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """A client-side rate limiter for an API with a request quota.
+
+    The bucket holds up to `capacity` requests and refills at `rate` requests per second.
+    Once the API has reported its remaining quota and reset time, requests are also paced so
+    the remaining quota lasts until the reset. The state lives in Redis when `redis_url` is
+    set, so every worker process shares it, and in this process otherwise.
+    """
+
+    def __init__(self, name: str, capacity: int, rate: float, redis_url: str = ""):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._updated_at = time.time()
+        self._quota = {}
+        self._redis = None
+        if redis_url:
+            try:
+                import redis
+
+                self._redis = redis.Redis.from_url(redis_url)
+                self._redis.ping()
+                self._acquire_script = self._redis.register_script(_ACQUIRE_SCRIPT)
+            except Exception as e:
+                logger.warning(f"Cannot share the {name} rate limit through Redis: {e}. Limiting this process only")
+                self._redis = None
+
+    def _try_acquire_local(self, now: float) -> float:
+        with self._lock:
+            capacity, rate = self.capacity, self.rate
+            remaining, reset = self._quota.get("remaining"), self._quota.get("reset")
+            if remaining is not None and reset and now < reset:
+                capacity = min(capacity, remaining)
+                rate = min(rate, remaining / (reset - now))
+
+            self._tokens = min(capacity, self._tokens + max(0.0, now - self._updated_at) * rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            if rate > 0:
+                return (1 - self._tokens) / rate
+            if reset and reset > now:
+                return reset - now
+            return _no_refill_wait
+
+    def _try_acquire(self) -> float:
+        now = time.time()
+        if self._redis is not None:
+            try:
+                return float(
+                    self._acquire_script(
+                        keys=[f"{self.name}:bucket", f"{self.name}:quota"], args=[now, self.capacity, self.rate, _no_refill_wait]
+                    )
+                )
+            except Exception as e:
+                logger.warning(f"Cannot reach Redis for the {self.name} rate limit: {e}. Limiting this process only")
+        return self._try_acquire_local(now)
+
+    def acquire(self, timeout: float = 3600):
+        """Waits until a request is allowed, instead of letting it fail on the API's rate limit.
+
+        Raises `RetryBudgetExceeded` if no request is allowed within `timeout` seconds or the task deadline.
+        """
+        deadline = time.monotonic() + retry.timeout_for(timeout)
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RetryBudgetExceeded(f"No {self.name} request allowed within the deadline, the next one is in {wait:.0f}s")
+            logger.info(f"{self.name} rate limit reached, waiting {wait:.1f}s")
+            time.sleep(wait)
+
+    def observe(self, headers: dict):
+        """Adapts the bucket to the quota reported in the `X-Ratelimit-*` response headers."""
+        try:
+            quota = {
+                "limit": int(headers["X-Ratelimit-Limit"]),
+                "remaining": int(headers["X-Ratelimit-Remaining"]),
+                "reset": int(headers["X-Ratelimit-Reset"]),
+            }
+        except (KeyError, ValueError):
+            return
+
+        with self._lock:
+            self._quota = quota
+        if self._redis is not None:
+            try:
+                key = f"{self.name}:quota"
+                self._redis.hset(key, mapping=quota)
+                self._redis.expireat(key, quota["reset"])
+            except Exception as e:
+                logger.warning(f"Cannot save the {self.name} quota to Redis: {e}")
+
+        if quota["remaining"] < quota["limit"] * 0.1:
+            logger.warning(f"{self.name} quota is running low: {quota['remaining']}/{quota['limit']} left until {time.ctime(quota['reset'])}")
+
+    def get_quota(self) -> dict:
+        """Returns the last reported quota: `limit`, `remaining` and `reset` (a UNIX timestamp), empty if unknown."""
+        if self._redis is not None:
+            try:
+                quota = self._redis.hgetall(f"{self.name}:quota")
+                return {k.decode("utf-8"): int(v) for k, v in quota.items()}
+            except Exception as e:
+                logger.warning(f"Cannot read the {self.name} quota from Redis: {e}")
+        with self._lock:
+            return dict(self._quota)
+
+
+_pexels_bucket: Optional[TokenBucket] = None
+_pexels_bucket_lock = threading.Lock()
+
+
+def _shared_redis_url(redis_url: str = "") -> str:
+    """Returns the Redis shared by the API and the workers: `redis_url`, then REDIS_URL, then the Celery broker."""
+    for url in (redis_url, os.getenv("REDIS_URL", ""), os.getenv("CELERY_BROKER_URL", "")):
+        if url and url.startswith(("redis://", "rediss://", "unix://")):
+            return url
+    return ""
+
+
+def get_pexels_bucket() -> TokenBucket:
+    """Returns the Pexels rate limiter of this process.
+
+    The limit is shared by every worker, and the quota is visible to the API, only through
+    Redis: `pexels.redis_url`, REDIS_URL or a Redis Celery broker.
+    """
+    global _pexels_bucket
+    with _pexels_bucket_lock:
+        if _pexels_bucket is None:
+            pexels_config = config.get("pexels", {})
+            requests_per_hour = pexels_config.get("requests_per_hour", 200)
+            redis_url = _shared_redis_url(pexels_config.get("redis_url", ""))
+            if not redis_url:
+                logger.warning(
+                    "No Redis configured for the Pexels rate limit: each process limits itself, "
+                    "and the API cannot report the quota. Set pexels.redis_url, REDIS_URL or CELERY_BROKER_URL"
+                )
+            _pexels_bucket = TokenBucket(
+                "pexels",
+                capacity=pexels_config.get("burst", 20),
+                rate=requests_per_hour / 3600,
+                redis_url=redis_url,
+            )
+        return _pexels_bucket
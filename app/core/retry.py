@@ -0,0 +1,342 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from loguru import logger
+
+from app import config
+from app.core.models.exception import CircuitOpenError, RetryBudgetExceeded
+
+_retry_config = config.get("retry", {})
+http_timeout = _retry_config.get("http_timeout", 30)
+
+
+# Client errors that may succeed when sent again
+_RETRYABLE_CLIENT_STATUSES = {408, 425, 429}
+
+
+def http_status(error: BaseException) -> Optional[int]:
+    """Returns the HTTP status of an error raised by requests, aiohttp or httpx, or None."""
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Returns False for HTTP client errors, such as a rejected API key, which fail the same way on every attempt."""
+    status = http_status(error)
+    return status is None or not 400 <= status < 500 or status in _RETRYABLE_CLIENT_STATUSES
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    Only errors accepted by `retryable` are retried; the others are raised at once.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 20.0,
+        retryable: Callable[[BaseException], bool] = is_retryable,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+default_policy = RetryPolicy(
+    max_attempts=_retry_config.get("max_attempts", 3),
+    base_delay=_retry_config.get("base_delay", 1.0),
+    max_delay=_retry_config.get("max_delay", 20.0),
+)
+
+
+class RetryBudget:
+    """A deadline and a cap on retries shared by everything a task does."""
+
+    def __init__(self, seconds: float, max_retries: int):
+        self.deadline = time.monotonic() + seconds
+        self.max_retries = max_retries
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def exhausted(self) -> bool:
+        return self.remaining() <= 0 or self.retries >= self.max_retries
+
+    def consume(self, name: str, is_retry: bool):
+        with self._lock:
+            if self.remaining() <= 0:
+                raise RetryBudgetExceeded(f"Task deadline exceeded before calling {name}")
+            if not is_retry:
+                return
+            if self.retries >= self.max_retries:
+                raise RetryBudgetExceeded(f"Task already retried {self.retries} times, no budget left to retry {name}")
+            self.retries += 1
+
+
+_budget: contextvars.ContextVar[Optional[RetryBudget]] = contextvars.ContextVar("retry_budget", default=None)
+
+
+@contextmanager
+def task_budget(seconds: float = 0, max_retries: int = 0):
+    """Limits the time and the retries of everything run inside the block.
+
+    A nested block reuses the budget of the outer one, so retries at every level share it.
+    Worker threads need `contextvars.copy_context().run` to see the budget.
+    """
+    if _budget.get() is not None:
+        yield _budget.get()
+        return
+
+    budget = RetryBudget(
+        seconds=seconds or _retry_config.get("task_budget_seconds", 900),
+        max_retries=max_retries or _retry_config.get("task_max_retries", 20),
+    )
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+def current_budget() -> Optional[RetryBudget]:
+    return _budget.get()
+
+
+def budget_exhausted() -> bool:
+    budget = _budget.get()
+    return budget is not None and budget.exhausted()
+
+
+def timeout_for(timeout: float) -> float:
+    """Caps the timeout of an upstream call by the time left before the task deadline.
+
+    Raises `RetryBudgetExceeded` if the deadline has already passed.
+    """
+    budget = _budget.get()
+    if budget is None:
+        return timeout
+    remaining = budget.remaining()
+    if remaining <= 0:
+        raise RetryBudgetExceeded("Task deadline exceeded")
+    return min(timeout, remaining)
+
+
+async def aiter_with_timeout(iterable: AsyncIterator, timeout: float) -> AsyncIterator:
+    """Yields from an async iterator, and cancels it when it is not exhausted after `timeout` seconds.
+
+    The timeout is capped by the task deadline. Raises `asyncio.TimeoutError` when it runs out.
+    """
+    deadline = time.monotonic() + timeout_for(timeout)
+    iterator = iterable.__aiter__()
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"Stream did not finish within {timeout}s")
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), remaining)
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class CircuitBreaker:
+    """Fails fast once a provider keeps failing, and lets one trial call through after `reset_timeout`."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.failures < self.failure_threshold:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let a trial call through, the next failure opens the circuit again
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.failures == self.failure_threshold:
+                    logger.warning(f"Circuit for {self.name} is open after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=_retry_config.get("breaker_failure_threshold", 5),
+                reset_timeout=_retry_config.get("breaker_reset_seconds", 60),
+            )
+        return _breakers[name]
+
+
+def _before_attempt(name: str, breaker: CircuitBreaker, is_retry: bool = False):
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit for {name} is open")
+    budget = _budget.get()
+    if budget is not None:
+        budget.consume(name, is_retry)
+
+
+class guard:
+    """Guards a single call that cannot be retried as a whole, such as a stream.
+
+    Raises like `call` when no attempt is allowed, and reports the outcome to the circuit breaker.
+    Works with both `with` and `async with`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = get_breaker(name)
+
+    def __enter__(self):
+        _before_attempt(self.name, self.breaker)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.breaker.record_success()
+        elif issubclass(exc_type, Exception) and is_retryable(exc):
+            self.breaker.record_failure()
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+def _delay(policy: RetryPolicy, attempt: int) -> float:
+    delay = policy.backoff(attempt)
+    budget = _budget.get()
+    if budget is not None:
+        delay = min(delay, budget.remaining())
+    return delay
+
+
+def call(func: Callable, *args, name: str, policy: RetryPolicy = None, timeout: float = None, **kwargs):
+    """Calls `func` with retries, backoff, the task budget and the circuit breaker of `name`.
+
+    If `timeout` is given, every attempt gets a `timeout` keyword argument, capped by the task
+    deadline, which `func` must pass on to the blocking call.
+
+    Raises the last error when every attempt fails, a non-retryable error such as an HTTP
+    4xx at once, and `RetryBudgetExceeded` or `CircuitOpenError` without calling `func` when
+    no attempt is allowed.
+    """
+    policy = policy or default_policy
+    breaker = get_breaker(name)
+    for attempt in range(policy.max_attempts):
+        _before_attempt(name, breaker, is_retry=attempt > 0)
+        if timeout is not None:
+            kwargs["timeout"] = timeout_for(timeout)
+        try:
+            result = func(*args, **kwargs)
+            breaker.record_success()
+            return result
+        except (RetryBudgetExceeded, CircuitOpenError):
+            raise
+        except Exception as e:
+            if not policy.retryable(e):
+                # The provider is up and answered; the request itself is wrong
+                logger.error(f"{name} failed with a non-retryable error: {e!r}")
+                raise
+            breaker.record_failure()
+            if attempt == policy.max_attempts - 1:
+                raise
+            delay = _delay(policy, attempt)
+            logger.warning(f"{name} failed: {e!r}. Retrying in {delay:.1f}s, attempt #{attempt + 2}")
+            time.sleep(delay)
+
+
+async def acall(func: Callable[..., Awaitable], *args, name: str, policy: RetryPolicy = None, timeout: float = None, **kwargs):
+    """Async version of `call`.
+
+    If `timeout` is given, an attempt still running after `timeout` seconds, or at the task
+    deadline, is cancelled.
+    """
+    policy = policy or default_policy
+    breaker = get_breaker(name)
+    for attempt in range(policy.max_attempts):
+        _before_attempt(name, breaker, is_retry=attempt > 0)
+        attempt_timeout = timeout_for(timeout) if timeout is not None else None
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), attempt_timeout)
+            breaker.record_success()
+            return result
+        except (RetryBudgetExceeded, CircuitOpenError):
+            raise
+        except Exception as e:
+            if not policy.retryable(e):
+                # The provider is up and answered; the request itself is wrong
+                logger.error(f"{name} failed with a non-retryable error: {e!r}")
+                raise
+            breaker.record_failure()
+            if attempt == policy.max_attempts - 1:
+                raise
+            delay = _delay(policy, attempt)
+            logger.warning(f"{name} failed: {e!r}. Retrying in {delay:.1f}s, attempt #{attempt + 2}")
+            await asyncio.sleep(delay)
+
+
+async def ahedged(primary: Callable[[], Awaitable], secondary: Callable[[], Awaitable], delay: float):
+    """Runs `primary`, and also `secondary` if `primary` has not succeeded after `delay` seconds.
+
+    Returns the first successful result and cancels the other request. Raises the error of
+    `primary` when both fail.
+    """
+    primary_task = asyncio.ensure_future(primary())
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    if done and primary_task.exception() is None:
+        return primary_task.result()
+
+    logger.info(f"Primary request is slow or failed after {delay}s, hedging with the secondary provider")
+    tasks = {primary_task, asyncio.ensure_future(secondary())}
+    try:
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        return primary_task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -5,6 +5,8 @@ import json
 import pandas as pd
 from loguru import logger
 
+from app.core import retry
+
 API_URL = "https://shortstories-api.onrender.com"
 
 ORG_STORIES = "data/stories.json"
@@ -53,7 +55,7 @@ def fetch_all_stories():
         with open(ORG_STORIES) as f:
             return json.load(f)
     except Exception as e:
-        response = requests.get(f"{API_URL}/stories")
+        response = requests.get(f"{API_URL}/stories", timeout=retry.timeout_for(retry.http_timeout))
         return response.json()
 
 
@@ -0,0 +1,222 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from typing import Optional
+
+from loguru import logger
+
+from app import config
+from app.core import retry
+from app.core.llm import agenerate_story_bundle
+from app.core.story import fetch_all_available_morals, fetch_all_stories
+from app.core.translation import remember
+
+_bank_config = config.get("story_bank", {})
+_concurrency = _bank_config.get("concurrency", 4)
+_lease_seconds = int(_bank_config.get("lease_minutes", 30) * 60)
+_max_attempts = _bank_config.get("max_attempts", 3)
+_language = config["video"].get("language", "English").lower().strip()
+
+
+class StoryBank:
+    """Stories, translated morals and search terms generated ahead of time, one row per moral.
+
+    Rows start as `pending` and become `ready` once generated. A worker leases rows before
+    generating them, so concurrent jobs never work on the same moral, and the rows of a
+    crashed job are picked up again once their lease expires.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+CREATE TABLE IF NOT EXISTS stories (
+    moral TEXT PRIMARY KEY,
+    moral_translated TEXT NOT NULL DEFAULT '',
+    example TEXT NOT NULL DEFAULT '',
+    story TEXT NOT NULL DEFAULT '',
+    search_terms TEXT NOT NULL DEFAULT '[]',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT NOT NULL DEFAULT '',
+    leased_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL DEFAULT 0,
+    used_count INTEGER NOT NULL DEFAULT 0,
+    last_used_at REAL NOT NULL DEFAULT 0
+)"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_status_used ON stories (status, used_count, last_used_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_moral_translated ON stories (moral_translated)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def seed(self, morals: dict, examples: dict = None) -> int:
+        """Adds the morals that are not in the bank yet as pending rows.
+
+        Args:
+            morals (dict): English morals mapped to their known translation, or "".
+            examples (dict, optional): English morals mapped to an example story.
+
+        Returns:
+            int: The number of morals added.
+        """
+        examples = examples or {}
+        rows = [(moral, translated or "", examples.get(moral, "")) for moral, translated in morals.items() if moral]
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO stories (moral, moral_translated, example) VALUES (?, ?, ?)", rows)
+            return conn.total_changes - before
+
+    def lease(self, limit: int, lease_seconds: int = _lease_seconds) -> list:
+        """Claims up to `limit` morals that still need a story.
+
+        Returns:
+            list: The leased rows as dicts.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT * FROM stories WHERE status != 'ready' AND attempts < ? AND leased_until < ? ORDER BY attempts, moral LIMIT ?",
+                (_max_attempts, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE stories SET leased_until = ? WHERE moral = ?", [(now + lease_seconds, row["moral"]) for row in rows]
+            )
+            conn.execute("COMMIT")
+        return [dict(row) for row in rows]
+
+    def complete(self, moral: str, moral_translated: str, story: str, search_terms: list):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE stories SET moral_translated = ?, story = ?, search_terms = ?, status = 'ready', error = '', "
+                "leased_until = 0, updated_at = ? WHERE moral = ?",
+                (moral_translated, story, json.dumps(search_terms, ensure_ascii=False), time.time(), moral),
+            )
+
+    def fail(self, moral: str, error: str):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE stories SET status = 'failed', attempts = attempts + 1, error = ?, leased_until = 0, updated_at = ? WHERE moral = ?",
+                (error, time.time(), moral),
+            )
+
+    def get(self, moral: str) -> Optional[dict]:
+        """Returns the ready entry of a moral, given in English or translated, or None."""
+        moral = moral.strip()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM stories WHERE (moral = ? OR moral_translated = ?) AND status = 'ready' ORDER BY moral = ? DESC LIMIT 1",
+                (moral, moral, moral),
+            ).fetchone()
+        return self._entry(row) if row else None
+
+    def pick(self) -> Optional[dict]:
+        """Returns the least used ready entry and marks it as used, or None if the bank has none."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM stories WHERE status = 'ready' ORDER BY used_count, last_used_at, RANDOM() LIMIT 1"
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE stories SET used_count = used_count + 1, last_used_at = ? WHERE moral = ?", (time.time(), row["moral"])
+                )
+            conn.execute("COMMIT")
+        return self._entry(row) if row else None
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM stories GROUP BY status").fetchall())
+
+    @staticmethod
+    def _entry(row: sqlite3.Row) -> dict:
+        return {
+            "moral": row["moral_translated"] or row["moral"],
+            "moral_en": row["moral"],
+            "story": row["story"],
+            "search_terms": json.loads(row["search_terms"]),
+        }
+
+
+_bank = None
+
+
+def get_story_bank() -> StoryBank:
+    global _bank
+    if _bank is None:
+        _bank = StoryBank(_bank_config.get("path", "./db/story_bank.sqlite3"))
+    return _bank
+
+
+async def _agenerate_entry(bank: StoryBank, row: dict, semaphore: asyncio.Semaphore):
+    moral = row["moral"]
+    async with semaphore:
+        try:
+            # Each moral gets its own retry budget, so one bad moral cannot starve the rest of the batch
+            with retry.task_budget():
+                bundle = await agenerate_story_bundle(moral, example=row["example"], use_cache=True)
+            if not bundle["story"] or not bundle["search_terms"]:
+                raise ValueError("empty story or search terms")
+        except Exception as e:
+            logger.error(f"Cannot pre-generate a story for moral '{moral}': {e}")
+            bank.fail(moral, str(e))
+            return False
+
+    # A translation from data/morals.json wins over the generated one, so the moral reads the same everywhere
+    if not row["moral_translated"] and _language == "vietnamese":
+        remember(moral, bundle["moral"])
+    bank.complete(moral, row["moral_translated"] or bundle["moral"], bundle["story"], bundle["search_terms"])
+    return True
+
+
+async def apregenerate(limit: int = 0, concurrency: int = _concurrency) -> dict:
+    """Generates the story, translated moral and search terms of every moral in the corpus that has none yet.
+
+    The job is resumable: finished morals are skipped, and it can be stopped and run again at any time.
+
+    Args:
+        limit (int, optional): Maximum number of morals to generate, 0 for all of them.
+        concurrency (int, optional): Number of morals generated at once.
+
+    Returns:
+        dict: The number of morals per status once the job is done.
+    """
+    bank = get_story_bank()
+    morals = fetch_all_available_morals()
+    examples = {}
+    for story in fetch_all_stories() or []:
+        examples.setdefault(story["moral"], story["story"])
+        morals.setdefault(story["moral"], "")
+    added = bank.seed(morals, examples)
+    logger.info(f"Added {added} new morals to the story bank")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    generated = 0
+    while not limit or generated < limit:
+        batch_size = concurrency * 4 if not limit else min(concurrency * 4, limit - generated)
+        rows = bank.lease(batch_size)
+        if not rows:
+            break
+        results = await asyncio.gather(*[_agenerate_entry(bank, row, semaphore) for row in rows])
+        generated += len(rows)
+        logger.info(f"Story bank: {sum(results)}/{len(rows)} morals generated in this batch")
+
+    stats = bank.stats()
+    logger.success(f"Story bank pre-generation done: {stats}")
+    return stats
+
+
+def pregenerate(limit: int = 0, concurrency: int = _concurrency) -> dict:
+    return asyncio.run(apregenerate(limit=limit, concurrency=concurrency))
+
+
+if __name__ == "__main__":
+    pregenerate()
@@ -1,3 +1,4 @@
+import math
 import os
 import glob
 import shutil
@@ -8,19 +9,21 @@ from loguru import logger
 
 from app import config
 from app.core.story import fetch_random_vi_story, fetch_short_story, fetch_all_available_morals, fetch_all_stories
-from app.core.images import get_images, image2video
+from app.core.images import acquire_images, render_clips
 from app.core.voice import create_voice_and_subtitle
 from app.core.video import generate_video, combine_videos
 from app.core.llm import generate_terms, translate_to_vietnamese, generate_story_from_moral
 from app.core.models.schema import VideoParams
-from app.core import telebot
+from app.core import retry, telebot
 from app.core.generator import generate_video_from_moral
+from app.core.story_bank import get_story_bank
 
 _max_retries = 3
 
 
 _output_folder = config["app"].get("output_folder", "./output")
 _voice_rate = config["video"].get("voice_rate", 1.0)
+_max_image_duration = config["video"].get("max_image_duration", 10)
 
 
 def init_task() -> str:
@@ -31,19 +34,31 @@ def init_task() -> str:
 
 
 def execute_task(task_id: str, delete_on_complete: bool = False):
+    with retry.task_budget():
+        _execute_task(task_id, delete_on_complete=delete_on_complete)
+
+
+def _execute_task(task_id: str, delete_on_complete: bool = False):
     for attemp in range(_max_retries):
+        if retry.budget_exhausted():
+            logger.error(f"Task {task_id} has no retry budget left")
+            break
+
         try:
             logger.info(f"Executing task {task_id}. Attemp {attemp}")
 
             output_folder = os.path.join(_output_folder, task_id)
 
-            # Fetch a random story
-            en2vi_morals = fetch_all_available_morals()
-            stories = fetch_all_stories()
-            story = random.choice([s for s in stories if s["moral"] in en2vi_morals])
+            # Stories are pre-generated by the nightly job, the LLM is only used when the bank is empty
+            story = get_story_bank().pick()
+            if story is None:
+                logger.warning("The story bank has no ready story. Generating one now")
+                en2vi_morals = fetch_all_available_morals()
+                stories = fetch_all_stories()
+                story = random.choice([s for s in stories if s["moral"] in en2vi_morals])
 
-            story["story"] = generate_story_from_moral(story["moral"], story["story"])
-            story["moral"] = en2vi_morals[story["moral"]]
+                story["story"] = generate_story_from_moral(story["moral"], story["story"])
+                story["moral"] = en2vi_morals[story["moral"]]
 
             assert story["moral"] and story["story"]
 
@@ -52,14 +67,7 @@ def execute_task(task_id: str, delete_on_complete: bool = False):
             if not search_terms:
                 search_terms = generate_terms(content=story["story"], amount=5)
 
-            images_folder = os.path.join(output_folder, "images")
-            os.makedirs(images_folder, exist_ok=True)
-            images = []
-            for search_term in search_terms:
-                images += get_images(query=search_term, output_folder=images_folder, amount=1)
-
-            assert len(images) > 0, "No images found"
-
+            # The voice comes first, so only as many images as the timeline needs are fetched
             audio_path = os.path.join(output_folder, "audio.mp3")
             subtitle_output_file, audio_duration = create_voice_and_subtitle(
                 voice_name="vi-VN-NamMinhNeural",
@@ -67,16 +75,21 @@ def execute_task(task_id: str, delete_on_complete: bool = False):
                 voice_output_file=audio_path,
                 voice_rate=_voice_rate,
             )
+            assert audio_duration > 0, "Cannot create the voice"
+
+            images_folder = os.path.join(output_folder, "images")
+            os.makedirs(images_folder, exist_ok=True)
+            images = acquire_images(search_terms, images_folder, total=math.ceil(audio_duration / _max_image_duration))
+
+            assert len(images) > 0, "No images found"
 
             output_video_folder = os.path.join(output_folder, "videos")
-            os.makedirs(output_video_folder, exist_ok=True)
-            for image_path in images:
-                video_path = os.path.join(output_video_folder, f"video-{os.path.basename(image_path)}.mp4")
-                image2video(image_path, video_path, audio_duration / len(images))
+            videos, _ = render_clips(images, output_video_folder, audio_duration / len(images))
+            assert len(videos) > 0, "No clips rendered"
 
             video_path = combine_videos(
                 os.path.join(output_folder, "video.mp4"),
-                glob.glob(os.path.join(output_video_folder, "*")),
+                videos,
                 audio_path,
                 max_clip_duration=audio_duration / len(images),
             )
@@ -105,26 +118,21 @@ def execute_task(task_id: str, delete_on_complete: bool = False):
 
 
 def execute_task_v2(task_id: str, delete_on_complete: bool = False):
-    for attemp in range(_max_retries):
-        try:
-            logger.info(f"Executing task {task_id}. Attemp {attemp}")
-
-            # Fetch a random story
-            en2vi_morals = fetch_all_available_morals()
-            stories = fetch_all_stories()
-            story = random.choice([s for s in stories if s["moral"] in en2vi_morals])
-
-            story["story"] = generate_story_from_moral(story["moral"], story["story"])
-            story["moral"] = en2vi_morals[story["moral"]]
-
-            generate_video_from_moral(story["moral"], task_id)
-            return
-
-        except Exception as e:
-            logger.error(f"Something wrong when execute task {task_id}. Trying again")
-            continue
-
-    logger.error(f"Failed to execute task {task_id}.")
+    logger.info(f"Executing task {task_id}")
+
+    # Stories are pre-generated by the nightly job, the LLM is only used when the bank is empty
+    story = get_story_bank().pick()
+    if story is not None:
+        moral = story["moral"]
+    else:
+        logger.warning("The story bank has no ready story. Generating one now")
+        en2vi_morals = fetch_all_available_morals()
+        stories = fetch_all_stories()
+        moral = en2vi_morals[random.choice([s for s in stories if s["moral"] in en2vi_morals])["moral"]]
+
+    # generate_video_from_moral retries on its own, within the task's retry budget
+    if not generate_video_from_moral(moral, task_id, story=story):
+        logger.error(f"Failed to execute task {task_id}.")
 
 
 if __name__ == "__main__":
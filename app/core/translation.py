@@ -0,0 +1,156 @@
+import difflib
+import fcntl
+import json
+import os
+import re
+import threading
+import unicodedata
+
+from loguru import logger
+
+from app import config
+from app.core.llm import atranslate_to_vietnamese
+from app.core.story import ALL_MORALS
+
+_translation_config = config.get("translation", {})
+_fuzzy_cutoff = _translation_config.get("fuzzy_cutoff", 0.9)
+# LLM translations are kept apart from the curated data/morals.json, which is never written
+_learned_path = _translation_config.get("learned_path", "./db/morals_learned.json")
+
+_lock = threading.Lock()
+_table = {}
+_normalized = {}
+_translations = set()
+_loaded_mtimes = None
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def _looks_english(text: str) -> bool:
+    # Vietnamese always has letters outside ASCII, English morals almost never do
+    return any(c.isalpha() for c in text) and all(c.isascii() for c in text if c.isalpha())
+
+
+def _load_table(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _refresh():
+    """Reloads the tables when a file changed, so translations added by other workers are seen."""
+    global _table, _normalized, _translations, _loaded_mtimes
+    mtimes = (_mtime(ALL_MORALS), _mtime(_learned_path))
+    if mtimes == _loaded_mtimes:
+        return
+
+    try:
+        # The curated translation of a moral wins over a learned one
+        table = {**_load_table(_learned_path), **_load_table(ALL_MORALS)}
+    except Exception as e:
+        logger.warning(f"Cannot load moral translations: {e}")
+        return
+    _table = {k: v for k, v in table.items() if v}
+    _normalized = {_normalize(k): v for k, v in _table.items()}
+    _translations = set(_table.values())
+    _loaded_mtimes = mtimes
+
+
+def lookup(moral: str) -> str:
+    """Finds the Vietnamese translation of a moral in data/morals.json without calling the LLM.
+
+    Tries an exact match, then a match ignoring case, punctuation and spacing, then the
+    closest moral above `translation.fuzzy_cutoff` similarity. Translations learned from
+    the LLM are looked up too. A moral that is already a known translation is returned as is.
+
+    Returns:
+        str: The translation, or "" if the moral is not in the table.
+    """
+    moral = moral.strip()
+    with _lock:
+        _refresh()
+        if moral in _table:
+            return _table[moral]
+        if moral in _translations:
+            return moral
+
+        normalized = _normalize(moral)
+        if normalized in _normalized:
+            return _normalized[normalized]
+
+        matches = difflib.get_close_matches(normalized, _normalized.keys(), n=1, cutoff=_fuzzy_cutoff)
+        if matches:
+            logger.info(f"Moral '{moral}' matched '{matches[0]}' in the translation table")
+            return _normalized[matches[0]]
+    return ""
+
+
+def remember(moral: str, translation: str):
+    """Saves an LLM translation to `translation.learned_path`, so the next lookup of the moral hits the table.
+
+    Only English morals that are not in the table yet are saved; anything else, such as a
+    moral that is already Vietnamese, is ignored. The file is locked while it is updated and
+    replaced atomically, so concurrent workers never lose each other's translations or read
+    a partial file.
+    """
+    moral, translation = moral.strip(), translation.strip()
+    if not moral or not translation or moral == translation or not _looks_english(moral):
+        return
+
+    with _lock:
+        _refresh()
+        if moral in _table or moral in _translations:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(_learned_path)), exist_ok=True)
+        with open(f"{_learned_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                table = _load_table(_learned_path)
+                if table.get(moral):
+                    return
+                table[moral] = translation
+
+                temp_file = f"{_learned_path}.{os.getpid()}.tmp"
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    json.dump(table, f, ensure_ascii=False, indent=4)
+                os.replace(temp_file, _learned_path)
+            except Exception as e:
+                logger.warning(f"Cannot save the translation of moral '{moral}': {e}")
+                return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        _table[moral] = translation
+        _normalized[_normalize(moral)] = translation
+        _translations.add(translation)
+    logger.info(f"Saved the translation of moral '{moral}'")
+
+
+async def atranslate_moral(moral: str) -> str:
+    """Translates a moral to Vietnamese, calling the LLM only when the table has no match.
+
+    The LLM response cache is consulted before the LLM itself, and new translations of
+    English morals are saved to `translation.learned_path`.
+    """
+    translation = lookup(moral)
+    if translation:
+        return translation
+
+    translation = await atranslate_to_vietnamese(moral, use_cache=True)
+    if translation:
+        remember(moral, translation)
+    return translation
@@ -1,7 +1,9 @@
 import json
 import locale
+import multiprocessing
 import os
 import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Any
 from uuid import uuid4
 
@@ -132,6 +134,14 @@ def run_in_background(func, *args, **kwargs):
     return thread
 
 
+def create_pool_executor(max_workers: int) -> Executor:
+    # Daemonic processes (e.g. Celery prefork workers) are not allowed to have children
+    if multiprocessing.current_process().daemon:
+        logger.warning("Running inside a daemonic process. Using threads instead of processes")
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
 def time_convert_seconds_to_hmsm(seconds) -> str:
     hours = int(seconds // 3600)
     seconds = seconds % 3600
@@ -197,6 +207,28 @@ def split_string_by_punctuations(s):
     return result
 
 
+def split_complete_sentences(s):
+    """Splits streamed text into the sentences that are complete so far and the unfinished rest.
+
+    Sentences keep their punctuation, so they can be spoken as they are. Each one can be
+    further split into subtitle lines with split_string_by_punctuations.
+    """
+    sentences = []
+    start = 0
+    for i in range(len(s) - 1):
+        char = s[i]
+        # A sentence ending is only known once the next character has arrived, e.g. "2.5" or "..."
+        if char == "\n" or (char in const.SENTENCE_ENDINGS and s[i + 1] not in const.SENTENCE_ENDINGS):
+            if char == "." and s[i - 1 : i].isdigit() and s[i + 1].isdigit():
+                continue
+            sentences.append(s[start : i + 1].strip())
+            start = i + 1
+
+    # drop fragments without any words, e.g. a lone "..."
+    sentences = [sentence for sentence in sentences if split_string_by_punctuations(sentence)]
+    return sentences, s[start:]
+
+
 def md5(text):
     import hashlib
 
@@ -1,8 +1,12 @@
+import functools
 import glob
+import math
 import os
 import random
-from typing import List
+import threading
+from typing import List, Optional
 
+from cachetools import LRUCache
 from loguru import logger
 from moviepy import (
     AudioFileClip,
@@ -15,14 +19,24 @@ from moviepy import (
     afx,
     concatenate_videoclips,
 )
-from moviepy.video.tools.subtitles import SubtitlesClip
+from moviepy.video.tools.subtitles import file_to_subtitles
 from PIL import ImageFont
 
 from app import config
 from app.core.models import const
-from app.core.models.schema import MaterialInfo, VideoAspect, VideoConcatMode, VideoParams
+from app.core.models.schema import MaterialInfo, MediaInfo, VideoAspect, VideoConcatMode, VideoParams
 from app.core import utils
+from app.core.ffmpeg import ass_filter, concat_videos, probe
+from app.core.images import image2clip
 
+_render_workers = config["video"].get("render_workers", 0)  # 0 means one worker per CPU
+
+# Rasterized subtitles, shared by every render in this process
+_subtitle_cache = LRUCache(
+    maxsize=config["video"].get("subtitle_cache_mb", 256) * 1024 * 1024,
+    getsizeof=lambda bitmap: sum(layer.nbytes for layer in bitmap if layer is not None),
+)
+_subtitle_cache_lock = threading.Lock()
 
 
 def get_bgm_file(bgm_file: str = ""):
@@ -31,6 +45,22 @@ def get_bgm_file(bgm_file: str = ""):
     return ""
 
 
+def _can_stream_copy(infos: List[MediaInfo], video_width: int, video_height: int, audio_duration: float, max_clip_duration: float) -> bool:
+    # Stream copy needs identical encoding parameters and no trimming, resizing or looping of any clip
+    first = infos[0]
+    if first.width != video_width or first.height != video_height or not first.fps:
+        return False
+    if any((info.codec, info.width, info.height, info.fps, info.pix_fmt) != (first.codec, first.width, first.height, first.fps, first.pix_fmt) for info in infos):
+        return False
+
+    # Clips are rendered with a whole number of frames, so allow one frame of slack per clip
+    frame = 1 / first.fps
+    if any(info.duration > max_clip_duration + frame for info in infos):
+        return False
+    total_duration = sum(info.duration for info in infos)
+    return audio_duration - frame <= total_duration <= audio_duration + frame * len(infos)
+
+
 def combine_videos(
     combined_video_path: str,
     video_paths: List[str],
@@ -40,17 +70,18 @@ def combine_videos(
     max_clip_duration: int = 5,
     threads: int = 2,
 ) -> str:
-    for i, video_path in enumerate(video_paths):
+    # Validate the inputs with a probe instead of opening a reader for each of them
+    infos = {}
+    for video_path in video_paths:
         try:
-            clip = VideoFileClip(video_path).without_audio()
+            info = probe(video_path)
+            assert info.duration > 0 and info.width > 0 and info.height > 0, "no video stream"
+            infos[video_path] = info
         except Exception as e:
-            logger.warning(f"Cannot process video {video_path}. Remove the video")
-            video_paths[i] = ""
-
-    video_paths = [vpath for vpath in video_paths if vpath]
+            logger.warning(f"Cannot process video {video_path}: {e}. Remove the video")
+    video_paths = list(infos)
 
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
+    audio_duration = probe(audio_file).duration
     logger.info(f"max duration of audio: {audio_duration} seconds")
     # Required duration of each clip
     req_dur = audio_duration / len(video_paths)
@@ -61,97 +92,138 @@ def combine_videos(
     aspect = VideoAspect(video_aspect)
     video_width, video_height = aspect.to_resolution()
 
+    if _can_stream_copy(list(infos.values()), video_width, video_height, audio_duration, max_clip_duration):
+        if video_concat_mode.value == VideoConcatMode.random.value:
+            random.shuffle(video_paths)
+        logger.info("all clips share the same encoding and need no trimming, joining them with stream copy")
+        concat_videos(video_paths, combined_video_path)
+        logger.success("completed")
+        return combined_video_path
+
+    # Keep the source frame rate when every clip has the same one
+    fps = infos[video_paths[0]].fps if len({info.fps for info in infos.values()}) == 1 else 30
+
     clips = []
     video_duration = 0
 
-    raw_clips = []
-    for video_path in video_paths:
-        clip = VideoFileClip(video_path).without_audio()
-        clip_duration = clip.duration
-        start_time = 0
-
-        while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)
-            split_clip = clip.subclipped(start_time, end_time)
-            raw_clips.append(split_clip)
-            # logger.info(f"splitting from {start_time:.2f} to {end_time:.2f}, clip duration {clip_duration:.2f}, split_clip duration {split_clip.duration:.2f}")
-            start_time = end_time
-            if video_concat_mode.value == VideoConcatMode.sequential.value:
-                break
-
-    # random video_paths order
-    if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(raw_clips)
-
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    while video_duration < audio_duration:
-        for clip in raw_clips:
-            # Check if clip is longer than the remaining audio
-            if (audio_duration - video_duration) < clip.duration:
-                clip = clip.subclipped(0, (audio_duration - video_duration))
-            # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
-            elif req_dur < clip.duration:
-                clip = clip.subclipped(0, req_dur)
-            clip = clip.with_fps(30)
-
-            # Not all videos are same size, so we need to resize them
-            clip_w, clip_h = clip.size
-            if clip_w != video_width or clip_h != video_height:
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-
-                if clip_ratio == video_ratio:
-                    # Resize proportionally
-                    clip = clip.resized((video_width, video_height))
-                else:
-                    # Resize proportionally
-                    if clip_ratio > video_ratio:
-                        # Resize proportionally based on the target width
-                        scale_factor = video_width / clip_w
+    # Every reader opened below is closed once the combined video is written
+    sources = []
+    try:
+        raw_clips = []
+        for video_path in video_paths:
+            clip = VideoFileClip(video_path, audio=False)
+            sources.append(clip)
+            clip_duration = clip.duration
+            start_time = 0
+
+            while start_time < clip_duration:
+                end_time = min(start_time + max_clip_duration, clip_duration)
+                split_clip = clip.subclipped(start_time, end_time)
+                raw_clips.append(split_clip)
+                # logger.info(f"splitting from {start_time:.2f} to {end_time:.2f}, clip duration {clip_duration:.2f}, split_clip duration {split_clip.duration:.2f}")
+                start_time = end_time
+                if video_concat_mode.value == VideoConcatMode.sequential.value:
+                    break
+
+        # random video_paths order
+        if video_concat_mode.value == VideoConcatMode.random.value:
+            random.shuffle(raw_clips)
+
+        # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
+        while video_duration < audio_duration:
+            for clip in raw_clips:
+                # Check if clip is longer than the remaining audio
+                if (audio_duration - video_duration) < clip.duration:
+                    clip = clip.subclipped(0, (audio_duration - video_duration))
+                # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
+                elif req_dur < clip.duration:
+                    clip = clip.subclipped(0, req_dur)
+                clip = clip.with_fps(fps)
+
+                # Not all videos are same size, so we need to resize them
+                clip_w, clip_h = clip.size
+                if clip_w != video_width or clip_h != video_height:
+                    clip_ratio = clip.w / clip.h
+                    video_ratio = video_width / video_height
+
+                    if clip_ratio == video_ratio:
+                        # Resize proportionally
+                        clip = clip.resized((video_width, video_height))
                     else:
-                        # Resize proportionally based on the target height
-                        scale_factor = video_height / clip_h
-
-                    new_width = int(clip_w * scale_factor)
-                    new_height = int(clip_h * scale_factor)
-                    clip_resized = clip.resized(new_size=(new_width, new_height))
-
-                    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
-                    clip = CompositeVideoClip(
-                        [
-                            background.with_duration(clip.duration),
-                            clip_resized.with_position("center"),
-                        ]
-                    )
+                        # Resize proportionally
+                        if clip_ratio > video_ratio:
+                            # Resize proportionally based on the target width
+                            scale_factor = video_width / clip_w
+                        else:
+                            # Resize proportionally based on the target height
+                            scale_factor = video_height / clip_h
+
+                        new_width = int(clip_w * scale_factor)
+                        new_height = int(clip_h * scale_factor)
+                        clip_resized = clip.resized(new_size=(new_width, new_height))
+
+                        background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
+                        clip = CompositeVideoClip(
+                            [
+                                background.with_duration(clip.duration),
+                                clip_resized.with_position("center"),
+                            ]
+                        )
+
+                    logger.info(f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}")
+
+                if clip.duration > max_clip_duration:
+                    clip = clip.subclipped(0, max_clip_duration)
+
+                clips.append(clip)
+                video_duration += clip.duration
+
+        video_clip = concatenate_videoclips(clips)
+        video_clip = video_clip.with_fps(fps)
+        logger.info("writing")
+        # https://github.com/harry0703/MoneyPrinterTurbo/issues/111#issuecomment-2032354030
+        video_clip.write_videofile(
+            filename=combined_video_path,
+            threads=threads,
+            logger=None,
+            temp_audiofile_path=output_dir,
+            audio_codec="aac",
+            fps=fps,
+        )
+        video_clip.close()
+    finally:
+        for source in sources:
+            source.close()
+    logger.success("completed")
+    return combined_video_path
 
-                logger.info(f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}")
 
-            if clip.duration > max_clip_duration:
-                clip = clip.subclipped(0, max_clip_duration)
+@functools.lru_cache(maxsize=16)
+def _load_font(font: str, fontsize: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font, fontsize)
 
-            clips.append(clip)
-            video_duration += clip.duration
 
-    video_clip = concatenate_videoclips(clips)
-    video_clip = video_clip.with_fps(30)
-    logger.info("writing")
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/111#issuecomment-2032354030
-    video_clip.write_videofile(
-        filename=combined_video_path,
-        threads=threads,
-        logger=None,
-        temp_audiofile_path=output_dir,
-        audio_codec="aac",
-        fps=30,
-    )
-    video_clip.close()
-    logger.success("completed")
-    return combined_video_path
+def _wrap_units(units: list, widths: list, separator: str, separator_width: float, max_width: float):
+    # Greedy wrapping on cumulative advances: every unit is measured once, so this is linear in the text length
+    lines = []
+    line = []
+    line_width = 0.0
+    for unit, unit_width in zip(units, widths):
+        new_width = line_width + separator_width + unit_width if line else unit_width
+        if line and new_width > max_width:
+            lines.append(separator.join(line))
+            line = [unit]
+            line_width = unit_width
+        else:
+            line.append(unit)
+            line_width = new_width
+    lines.append(separator.join(line))
+    return lines
 
 
 def wrap_text(text, max_width, font="Arial", fontsize=60):
     # Create ImageFont
-    font = ImageFont.truetype(font, fontsize)
+    font = _load_font(font, fontsize)
 
     def get_text_size(inner_text):
         inner_text = inner_text.strip()
@@ -164,91 +236,69 @@ def wrap_text(text, max_width, font="Arial", fontsize=60):
 
     # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
 
-    processed = True
+    words = [word for word in text.split(" ") if word]
+    word_widths = [font.getlength(word) for word in words]
+    if words and max(word_widths) <= max_width:
+        _wrapped_lines_ = _wrap_units(words, word_widths, " ", font.getlength(" "), max_width)
+    else:
+        # A single word is wider than the line, wrap by characters instead
+        chars = list(text)
+        _wrapped_lines_ = _wrap_units(chars, [font.getlength(char) for char in chars], "", 0.0, max_width)
 
-    _wrapped_lines_ = []
-    words = text.split(" ")
-    _txt_ = ""
-    for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
-    _wrapped_lines_.append(_txt_)
-    if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
-        result = "\n".join(_wrapped_lines_).strip()
-        height = len(_wrapped_lines_) * height
-        # logger.warning(f"wrapped text: {result}")
-        return result, height
-
-    _wrapped_lines_ = []
-    chars = list(text)
-    _txt_ = ""
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            _wrapped_lines_.append(_txt_)
-            _txt_ = ""
-    _wrapped_lines_.append(_txt_)
+    _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
     result = "\n".join(_wrapped_lines_).strip()
     height = len(_wrapped_lines_) * height
     # logger.warning(f"wrapped text: {result}")
     return result, height
 
 
-def generate_video(
-    video_path: str,
-    audio_path: str,
-    subtitle_path: str,
-    output_file: str,
-    params: VideoParams,
-):
-    aspect = VideoAspect(params.video_aspect)
-    video_width, video_height = aspect.to_resolution()
+def _get_font_path() -> str:
+    font_path = config["video"].get("font_path")
+    if not (font_path and os.path.exists(font_path)):
+        logger.error(f"Font not found: {font_path}")
+        return ""
 
-    logger.info(f"Generating video:\n{params}")
-    logger.info(f"start, video size: {video_width} x {video_height}")
-    logger.info(f"① video: {video_path}")
-    logger.info(f"② audio: {audio_path}")
-    logger.info(f"③ subtitle: {subtitle_path}")
-    logger.info(f"④ output: {output_file}")
+    if os.name == "nt":
+        font_path = font_path.replace("\\", "/")
 
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
-    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
-    # write into the same directory as the output file
-    output_dir = os.path.dirname(output_file)
+    logger.info(f"using font: {font_path}")
+    return font_path
 
-    font_path = ""
-    if params.subtitle_enabled:
-        font_path = config["video"].get("font_path")
-        if not (font_path and os.path.exists(font_path)):
-            logger.error(f"Font not found: {font_path}")
-            return ""
 
-        if os.name == "nt":
-            font_path = font_path.replace("\\", "/")
+def _load_subtitles(subtitle_path: str) -> list:
+    # ASS subtitles are burned in by ffmpeg while encoding, see _subtitle_ffmpeg_params
+    if not (subtitle_path and os.path.exists(subtitle_path)) or subtitle_path.endswith(".ass"):
+        return []
+    return file_to_subtitles(subtitle_path, encoding="utf-8")
 
-        logger.info(f"using font: {font_path}")
 
-    def create_text_clip(subtitle_item):
-        params.font_size = int(params.font_size)
-        params.stroke_width = int(params.stroke_width)
-        phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(phrase, max_width=max_width, font=font_path, fontsize=params.font_size)
-        _clip = TextClip(
-            text=wrapped_txt,
+def _subtitle_ffmpeg_params(subtitle_path: str, font_path: str, offset: float = 0.0):
+    if not (subtitle_path and os.path.exists(subtitle_path)) or not subtitle_path.endswith(".ass"):
+        return None
+    return ["-vf", ass_filter(subtitle_path, fonts_dir=os.path.dirname(font_path), offset=offset)]
+
+
+def _create_cached_text_clip(text: str, font_path: str, params: VideoParams) -> ImageClip:
+    """Creates a text clip from a cached RGBA bitmap, rasterizing the text only on a cache miss.
+
+    The clip is only as large as the text, so compositing it blends just that box
+    instead of the whole frame.
+    """
+    key = (
+        text,
+        font_path,
+        params.font_size,
+        params.text_fore_color,
+        params.text_background_color,
+        params.stroke_color,
+        params.stroke_width,
+    )
+    with _subtitle_cache_lock:
+        bitmap = _subtitle_cache.get(key)
+
+    if bitmap is None:
+        text_clip = TextClip(
+            text=text,
             font=font_path,
             font_size=params.font_size,
             color=params.text_fore_color,
@@ -256,44 +306,62 @@ def generate_video(
             stroke_color=params.stroke_color,
             stroke_width=params.stroke_width,
         )
+        bitmap = (text_clip.get_frame(0), text_clip.mask.get_frame(0) if text_clip.mask is not None else None)
+        text_clip.close()
+        with _subtitle_cache_lock:
+            _subtitle_cache[key] = bitmap
+
+    rgb, alpha = bitmap
+    clip = ImageClip(rgb)
+    if alpha is not None:
+        clip = clip.with_mask(ImageClip(alpha, is_mask=True))
+    return clip
+
+
+def wrap_subtitle(text: str, font_path: str, font_size: int, video_width: int) -> tuple:
+    """Wraps a subtitle to the width it is shown at, the same way for text clips and ASS.
+
+    Returns:
+        tuple: The wrapped text and its height in pixels.
+    """
+    return wrap_text(text, max_width=video_width * 0.9, font=font_path, fontsize=int(font_size))
+
+
+def subtitle_top(params: VideoParams, video_height: int, text_height: float) -> Optional[float]:
+    """Returns the top of a subtitle block of `text_height` pixels, or None to center it vertically."""
+    if params.subtitle_position == "bottom":
+        return video_height * 0.95 - text_height
+    if params.subtitle_position == "top":
+        return video_height * 0.05
+    if params.subtitle_position == "custom":
+        # Ensure the subtitle is fully within the screen bounds
+        margin = 10  # Additional margin, in pixels
+        custom_y = (video_height - text_height) * (params.custom_position / 100)
+        return max(margin, min(custom_y, video_height - text_height - margin))  # Constrain the y value within the valid range
+    return None
+
+
+def _create_subtitle_clips(subtitle_items: list, params: VideoParams, font_path: str, video_width: int, video_height: int) -> list:
+    def create_text_clip(subtitle_item):
+        params.font_size = int(params.font_size)
+        params.stroke_width = int(params.stroke_width)
+        phrase = subtitle_item[1]
+        wrapped_txt, txt_height = wrap_subtitle(phrase, font_path, params.font_size, video_width)
+        _clip = _create_cached_text_clip(wrapped_txt, font_path, params)
         duration = subtitle_item[0][1] - subtitle_item[0][0]
         _clip = _clip.with_start(subtitle_item[0][0])
         _clip = _clip.with_end(subtitle_item[0][1])
         _clip = _clip.with_duration(duration)
-        if params.subtitle_position == "bottom":
-            _clip = _clip.with_position(("center", video_height * 0.95 - _clip.h))
-        elif params.subtitle_position == "top":
-            _clip = _clip.with_position(("center", video_height * 0.05))
-        elif params.subtitle_position == "custom":
-            # Ensure the subtitle is fully within the screen bounds
-            margin = 10  # Additional margin, in pixels
-            max_y = video_height - _clip.h - margin
-            min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(min_y, min(custom_y, max_y))  # Constrain the y value within the valid range
-            _clip = _clip.with_position(("center", custom_y))
-        else:  # center
-            _clip = _clip.with_position(("center", "center"))
+        top = subtitle_top(params, video_height, _clip.h)
+        _clip = _clip.with_position(("center", "center" if top is None else top))
         return _clip
 
-    video_clip = VideoFileClip(video_path)
-    audio_clip = AudioFileClip(audio_path)
-    # audio_clip = AudioFileClip(audio_path).with_effects([afx.MultiplyVolume(params.voice_volume)])
+    return [create_text_clip(subtitle_item=item) for item in subtitle_items]
 
-    def make_textclip(text):
-        return TextClip(
-            text=text,
-            font=font_path,
-            font_size=params.font_size,
-        )
 
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding="utf-8", make_textclip=make_textclip)
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+def _create_audio_clip(audio_path: str, params: VideoParams, duration: float):
+    audio_clip = AudioFileClip(audio_path)
+    # audio_clip = AudioFileClip(audio_path).with_effects([afx.MultiplyVolume(params.voice_volume)])
 
     bgm_file = get_bgm_file(bgm_file=params.bgm_file)
     logger.info(f"Using background music: {bgm_file if bgm_file else None}")
@@ -304,26 +372,259 @@ def generate_video(
                 [
                     # afx.MultiplyVolume(params.voice_volume),
                     afx.AudioFadeOut(3),
-                    afx.AudioLoop(duration=video_clip.duration),
+                    afx.AudioLoop(duration=duration),
                 ]
             )
             audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
         except Exception as e:
             logger.error(f"failed to add bgm: {str(e)}")
 
-    video_clip = video_clip.with_audio(audio_clip)
+    return audio_clip
+
+
+def generate_video(
+    video_path: str,
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+):
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    logger.info(f"Generating video:\n{params}")
+    logger.info(f"start, video size: {video_width} x {video_height}")
+    logger.info(f"① video: {video_path}")
+    logger.info(f"② audio: {audio_path}")
+    logger.info(f"③ subtitle: {subtitle_path}")
+    logger.info(f"④ output: {output_file}")
+
+    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
+    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
+    # write into the same directory as the output file
+    output_dir = os.path.dirname(output_file)
+
+    font_path = ""
+    if params.subtitle_enabled:
+        font_path = _get_font_path()
+        if not font_path:
+            return ""
+
+    source_clip = VideoFileClip(video_path)
+    audio_clip = None
+    try:
+        video_clip = source_clip
+        text_clips = _create_subtitle_clips(_load_subtitles(subtitle_path), params, font_path, video_width, video_height)
+        if text_clips:
+            video_clip = CompositeVideoClip([video_clip, *text_clips])
+
+        audio_clip = _create_audio_clip(audio_path, params, video_clip.duration)
+
+        video_clip = video_clip.with_audio(audio_clip)
+        video_clip.write_videofile(
+            output_file,
+            audio_codec="aac",
+            temp_audiofile_path=output_dir,
+            threads=params.n_threads or 2,
+            logger=None,
+            fps=30,
+            ffmpeg_params=_subtitle_ffmpeg_params(subtitle_path, font_path),
+        )
+        video_clip.close()
+        del video_clip
+    finally:
+        source_clip.close()
+        if audio_clip is not None:
+            audio_clip.close()
+
+    logger.info(f"Final video saved to {video_path}")
+
+
+def generate_video_from_images(
+    image_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    audio_duration: float,
+) -> str:
+    """Renders the final video straight from the images in a single encode.
+
+    Pan clips, concatenation, subtitles, voice and background music are composed into
+    one timeline, so every frame is encoded exactly once. The images that load share
+    `audio_duration` evenly, so a skipped image does not cut the video short.
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    logger.info(f"Generating video in a single pass:\n{params}")
+    logger.info(f"start, video size: {video_width} x {video_height}")
+    logger.info(f"① images: {len(image_paths)}, {audio_duration:.2f} seconds in total")
+    logger.info(f"② audio: {audio_path}")
+    logger.info(f"③ subtitle: {subtitle_path}")
+    logger.info(f"④ output: {output_file}")
+
+    output_dir = os.path.dirname(output_file)
+
+    font_path = ""
+    if params.subtitle_enabled:
+        font_path = _get_font_path()
+        if not font_path:
+            return ""
+
+    clips, loaded_paths = [], []
+    for image_path in image_paths:
+        try:
+            clips.append(image2clip(image_path, audio_duration / len(image_paths), video_width, video_height))
+            loaded_paths.append(image_path)
+        except Exception as e:
+            logger.warning(f"Cannot create clip from image {image_path}: {e}. Skip the image")
+
+    if not clips:
+        logger.error("No clips to render")
+        return ""
+    if len(clips) < len(image_paths):
+        # The pan speed depends on the duration, so the remaining clips are recreated to cover the whole voice
+        for clip in clips:
+            clip.close()
+        clip_duration = audio_duration / len(loaded_paths)
+        logger.info(f"Using {len(loaded_paths)} images, {clip_duration:.2f} seconds each")
+        clips = [image2clip(image_path, clip_duration, video_width, video_height) for image_path in loaded_paths]
+
+    audio_clip = None
+    try:
+        video_clip = concatenate_videoclips(clips)
+
+        text_clips = _create_subtitle_clips(_load_subtitles(subtitle_path), params, font_path, video_width, video_height)
+        if text_clips:
+            video_clip = CompositeVideoClip([video_clip, *text_clips])
+
+        audio_clip = _create_audio_clip(audio_path, params, video_clip.duration)
+        video_clip = video_clip.with_audio(audio_clip)
+        video_clip.write_videofile(
+            output_file,
+            audio_codec="aac",
+            temp_audiofile_path=output_dir,
+            threads=params.n_threads or 2,
+            logger=None,
+            fps=30,
+            ffmpeg_params=_subtitle_ffmpeg_params(subtitle_path, font_path),
+        )
+        video_clip.close()
+        del video_clip
+    finally:
+        # Release the image clips and ffmpeg readers even when the render fails partway
+        for clip in clips:
+            clip.close()
+        if audio_clip is not None:
+            audio_clip.close()
+
+    logger.info(f"Final video saved to {output_file}")
+    return output_file
+
+
+def _render_segment(
+    image_path: str,
+    duration: float,
+    subtitle_items: list,
+    params: VideoParams,
+    font_path: str,
+    output_file: str,
+    subtitle_path: str = "",
+    offset: float = 0.0,
+    fps: int = 30,
+) -> str:
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    video_clip = image2clip(image_path, duration, video_width, video_height)
+    text_clips = _create_subtitle_clips(subtitle_items, params, font_path, video_width, video_height)
+    if text_clips:
+        video_clip = CompositeVideoClip([video_clip, *text_clips])
+
+    # Every segment is encoded with the same settings, so they can be joined with stream copy.
+    # The output rate is forced because the setpts filters of an offset subtitle drop the input rate.
     video_clip.write_videofile(
         output_file,
-        audio_codec="aac",
-        temp_audiofile_path=output_dir,
-        threads=params.n_threads or 2,
+        codec="libx264",
+        audio=False,
+        threads=1,
         logger=None,
-        fps=30,
+        fps=fps,
+        ffmpeg_params=(_subtitle_ffmpeg_params(subtitle_path, font_path, offset=offset) or []) + ["-r", str(fps)],
     )
     video_clip.close()
-    del video_clip
+    return output_file
 
-    logger.info(f"Final video saved to {video_path}")
+
+def generate_video_segmented(
+    image_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    clip_duration: float,
+    max_workers: int = 0,
+) -> str:
+    """Renders the final video as one segment per image, encoded in parallel processes.
+
+    The timeline is split at clip boundaries; subtitles crossing a boundary are split
+    between both segments. The segments are joined with stream copy and the mixed
+    audio track is muxed in without re-encoding the video.
+    """
+    # Segment boundaries and subtitle offsets must fall on frames, or they drift over the timeline
+    fps = 30
+    clip_duration = math.ceil(round(clip_duration * fps, 6)) / fps
+
+    logger.info(f"Generating video in segments:\n{params}")
+    logger.info(f"① images: {len(image_paths)}, {clip_duration:.2f} seconds each")
+    logger.info(f"② audio: {audio_path}")
+    logger.info(f"③ subtitle: {subtitle_path}")
+    logger.info(f"④ output: {output_file}")
+
+    output_dir = os.path.dirname(output_file)
+    segments_dir = os.path.join(output_dir, "segments")
+    os.makedirs(segments_dir, exist_ok=True)
+
+    font_path = ""
+    if params.subtitle_enabled:
+        font_path = _get_font_path()
+        if not font_path:
+            return ""
+
+    subtitle_items = _load_subtitles(subtitle_path)
+
+    max_workers = max(1, min(max_workers or _render_workers or os.cpu_count() or 1, len(image_paths)))
+    logger.info(f"Rendering {len(image_paths)} segments with {max_workers} workers")
+
+    futures = []
+    with utils.create_pool_executor(max_workers) as executor:
+        for i, image_path in enumerate(image_paths):
+            seg_start, seg_end = i * clip_duration, (i + 1) * clip_duration
+            seg_subtitles = [
+                ((max(start, seg_start) - seg_start, min(end, seg_end) - seg_start), text)
+                for (start, end), text in subtitle_items
+                if start < seg_end and end > seg_start
+            ]
+            segment_file = os.path.join(segments_dir, f"segment-{i:03d}.mp4")
+            futures.append(
+                executor.submit(
+                    _render_segment, image_path, clip_duration, seg_subtitles, params, font_path, segment_file, subtitle_path, seg_start, fps
+                )
+            )
+
+    # A missing segment would shift every subtitle after it, so any failure fails the render
+    segment_files = [future.result() for future in futures]
+
+    audio_clip = _create_audio_clip(audio_path, params, clip_duration * len(image_paths))
+    audio_file = os.path.join(output_dir, "audio-final.m4a")
+    audio_clip.write_audiofile(audio_file, codec="aac", logger=None)
+    audio_clip.close()
+
+    concat_videos(segment_files, output_file, audio_file=audio_file)
+
+    logger.info(f"Final video saved to {output_file}")
+    return output_file
 
 
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
@@ -2,7 +2,7 @@ import asyncio
 import os
 import re
 from datetime import datetime
-from typing import Union
+from typing import AsyncIterator, Union
 from xml.sax.saxutils import unescape
 
 import edge_tts
@@ -11,7 +11,15 @@ from edge_tts.submaker import mktimestamp
 from loguru import logger
 from moviepy.video.tools import subtitles
 
-from app.core import utils
+from app import config
+from app.core import retry, utils
+from app.core.models.schema import VideoAspect, VideoParams
+from app.core.video import _load_font, subtitle_top, wrap_subtitle
+
+_max_tts_concurrency = config["video"].get("tts_concurrency", 4)
+_tts_timeout = config["video"].get("tts_timeout", 120)
+# edge-tts streams "audio-24khz-48kbitrate-mono-mp3", the duration of a sentence follows from its size
+_TTS_BITRATE = 48000
 
 
 def get_all_azure_voices(filter_locals=None) -> list[str]:
@@ -1070,31 +1078,32 @@ def azure_tts_v1(text: str, voice_name: str, voice_rate: float, voice_file: str)
     voice_name = parse_voice_name(voice_name)
     text = text.strip()
     rate_str = convert_rate_to_percent(voice_rate)
-    for i in range(3):
-        try:
-            logger.info(f"start, voice name: {voice_name}, try: {i + 1}")
-
-            async def _do() -> SubMaker:
-                communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
-                sub_maker = edge_tts.SubMaker()
-                with open(voice_file, "wb") as file:
-                    async for chunk in communicate.stream():
-                        if chunk["type"] == "audio":
-                            file.write(chunk["data"])
-                        elif chunk["type"] == "WordBoundary":
-                            sub_maker.create_sub((chunk["offset"], chunk["duration"]), chunk["text"])
-                return sub_maker
-
-            sub_maker = asyncio.run(_do())
-            if not sub_maker or not sub_maker.subs:
-                logger.warning("failed, sub_maker is None or sub_maker.subs is None")
-                continue
-
-            logger.info(f"completed, output file: {voice_file}")
-            return sub_maker
-        except Exception as e:
-            logger.error(f"failed, error: {str(e)}")
-    return None
+    logger.info(f"start, voice name: {voice_name}")
+
+    async def _do() -> SubMaker:
+        communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
+        sub_maker = edge_tts.SubMaker()
+        with open(voice_file, "wb") as file:
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    file.write(chunk["data"])
+                elif chunk["type"] == "WordBoundary":
+                    sub_maker.create_sub((chunk["offset"], chunk["duration"]), chunk["text"])
+        if not sub_maker.subs:
+            raise ValueError("sub_maker.subs is empty")
+        return sub_maker
+
+    def _run(timeout: float) -> SubMaker:
+        return asyncio.run(asyncio.wait_for(_do(), timeout))
+
+    try:
+        sub_maker = retry.call(_run, name="edge-tts", timeout=_tts_timeout)
+    except Exception as e:
+        logger.error(f"failed, error: {str(e)}")
+        return None
+
+    logger.info(f"completed, output file: {voice_file}")
+    return sub_maker
 
 
 # def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker, None]:
@@ -1181,12 +1190,69 @@ def _format_text(text: str) -> str:
     return text
 
 
-def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
+def _ass_color(color: str) -> str:
+    # "#RRGGBB" -> "&H00BBGGRR"
+    color = color.lstrip("#")
+    if len(color) != 6:
+        return "&H00FFFFFF"
+    return f"&H00{color[4:6]}{color[2:4]}{color[0:2]}".upper()
+
+
+def _ass_timestamp(seconds: float) -> str:
+    centiseconds = int(round(seconds * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def _create_ass_subtitle(items: list, subtitle_file: str, params: VideoParams):
+    """Writes the subtitle items as a styled ASS file that ffmpeg/libass burns in during encode."""
+    video_width, video_height = VideoAspect(params.video_aspect).to_resolution()
+    font_path = config["video"].get("font_path")
+    font_size = int(params.font_size)
+    font_name = _load_font(font_path, font_size).getname()[0]
+
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        "WrapStyle: 0",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, "
+        "ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{font_name},{font_size},{_ass_color(params.text_fore_color)},&H000000FF,{_ass_color(params.stroke_color)},&H00000000,"
+        f"0,0,0,0,100,100,0,0,1,{int(params.stroke_width)},0,5,{int(video_width * 0.05)},{int(video_width * 0.05)},0,1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+
+    for start_time, end_time, sub_text in items:
+        # Wrapped and placed like the moviepy text clips, the style centers the lines without a position
+        wrapped_txt, txt_height = wrap_subtitle(sub_text, font_path, font_size, video_width)
+        sub_text = wrapped_txt.replace("\\", "\\\\").replace("\n", "\\N")
+        top = subtitle_top(params, video_height, txt_height)
+        if top is not None:
+            sub_text = f"{{\\an8\\pos({video_width // 2},{int(top)})}}{sub_text}"
+        lines.append(f"Dialogue: 0,{_ass_timestamp(start_time)},{_ass_timestamp(end_time)},Default,,0,0,0,,{sub_text}")
+
+    with open(subtitle_file, "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str, params: VideoParams = None):
     """
     优化字幕文件
     1. 将字幕文件按照标点符号分割成多行
     2. 逐行匹配字幕文件中的文本
     3. 生成新的字幕文件
+
+    A `.ass` subtitle file is written as a styled ASS script using the font, colours,
+    stroke and position from `params`; any other extension is written as SRT.
     """
 
     text = _format_text(text)
@@ -1240,19 +1306,24 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
             sub_text = match_line(sub_line, sub_index)
             if sub_text:
                 sub_index += 1
-                line = formatter(
-                    idx=sub_index,
-                    start_time=start_time,
-                    end_time=end_time,
-                    sub_text=sub_text,
-                )
-                sub_items.append(line)
+                sub_items.append((start_time, end_time, sub_text))
                 start_time = -1.0
                 sub_line = ""
 
+        if subtitle_file.endswith(".ass"):
+            # Offsets are in 100-nanosecond units
+            _create_ass_subtitle(
+                [(start / 10000000, end / 10000000, sub_text) for start, end, sub_text in sub_items],
+                subtitle_file,
+                params or VideoParams(),
+            )
+            logger.info(f"completed, subtitle file created: {subtitle_file}, duration: {sub_items[-1][1] / 10000000}")
+            return
+
         # if len(sub_items) == len(script_lines):
         with open(subtitle_file, "w", encoding="utf-8") as file:
-            file.write("\n".join(sub_items) + "\n")
+            lines = [formatter(idx=i + 1, start_time=start, end_time=end, sub_text=sub_text) for i, (start, end, sub_text) in enumerate(sub_items)]
+            file.write("\n".join(lines) + "\n")
         try:
             sbs = subtitles.file_to_subtitles(subtitle_file, encoding="utf-8")
             duration = max([tb for ((ta, tb), txt) in sbs])
@@ -1273,14 +1344,21 @@ def get_audio_duration(sub_maker: submaker.SubMaker):
     return sub_maker.offset[-1][1] / 10000000
 
 
-def create_voice_and_subtitle(voice_name: str, text: str, voice_output_file: str, voice_rate: float = 1.0):
+def create_voice_and_subtitle(
+    voice_name: str,
+    text: str,
+    voice_output_file: str,
+    voice_rate: float = 1.0,
+    subtitle_format: str = "srt",
+    params: VideoParams = None,
+):
     logger.info("Creating audio and subtitle. params:\n\tvoice_name: {voice_name}\n\tvoice_rate: {voice_rate}")
     logger.info(f"Voice name: {voice_name}")
     logger.info(f"Text: {text}")
 
     sub_maker = tts(text=text, voice_name=voice_name, voice_rate=voice_rate, voice_file=voice_output_file)
-    subtitle_output_file = voice_output_file + ".srt"
-    create_subtitle(sub_maker=sub_maker, text=text, subtitle_file=subtitle_output_file)
+    subtitle_output_file = f"{voice_output_file}.{subtitle_format}"
+    create_subtitle(sub_maker=sub_maker, text=text, subtitle_file=subtitle_output_file, params=params)
     audio_duration = get_audio_duration(sub_maker)
 
     logger.info(f"voice: {voice_name}, audio duration: {audio_duration}s")
@@ -1298,6 +1376,88 @@ def create_voice_and_subtitle(voice_name: str, text: str, voice_output_file: str
     return subtitle_output_file, audio_duration
 
 
+async def _atts_sentence(text: str, voice_name: str, rate_str: str) -> tuple:
+    audio = bytearray()
+    boundaries = []
+    communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            audio.extend(chunk["data"])
+        elif chunk["type"] == "WordBoundary":
+            boundaries.append((chunk["offset"], chunk["duration"], chunk["text"]))
+    if not boundaries:
+        raise ValueError(f"No word boundaries for sentence: {text}")
+    return bytes(audio), boundaries
+
+
+async def acreate_voice_and_subtitle_from_stream(
+    voice_name: str,
+    sentences: AsyncIterator[str],
+    voice_output_file: str,
+    voice_rate: float = 1.0,
+    subtitle_format: str = "srt",
+    params: VideoParams = None,
+):
+    """Synthesizes sentences as they arrive and stitches them into one audio track and subtitle timeline.
+
+    Each sentence is sent to TTS as soon as it is yielded, so synthesis overlaps with the
+    generation of the following sentences. Audio is written to the output in order as soon
+    as the leading sentences are ready.
+
+    Returns:
+        tuple: The subtitle file, the audio duration in seconds and the full text.
+    """
+    voice_name = parse_voice_name(voice_name)
+    rate_str = convert_rate_to_percent(voice_rate)
+    logger.info(f"Creating audio and subtitle from a stream. voice name: {voice_name}, voice rate: {rate_str}")
+
+    semaphore = asyncio.Semaphore(_max_tts_concurrency)
+
+    async def synthesize(text: str) -> tuple:
+        async with semaphore:
+            return await retry.acall(_atts_sentence, text, voice_name, rate_str, name="edge-tts", timeout=_tts_timeout)
+
+    texts = []
+    pending = []
+    sub_maker = SubMaker()
+    elapsed = 0  # in 100-nanosecond units, like the word boundary offsets
+
+    with open(voice_output_file, "wb") as file:
+
+        def write(audio: bytes, boundaries: list):
+            nonlocal elapsed
+            file.write(audio)
+            for offset, duration, word in boundaries:
+                sub_maker.create_sub((elapsed + offset, duration), word)
+            # Sentences are concatenated as they are, so the next one starts where this audio ends
+            elapsed += len(audio) * 8 * 10000000 // _TTS_BITRATE
+
+        try:
+            async for sentence in sentences:
+                texts.append(sentence)
+                pending.append(asyncio.ensure_future(synthesize(sentence)))
+                if len(texts) == 1:
+                    logger.info("First sentence sent to TTS")
+                while pending and pending[0].done():
+                    write(*pending.pop(0).result())
+
+            while pending:
+                write(*(await pending[0]))
+                pending.pop(0)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+
+    text = "\n".join(texts)
+    subtitle_output_file = f"{voice_output_file}.{subtitle_format}"
+    create_subtitle(sub_maker=sub_maker, text=text, subtitle_file=subtitle_output_file, params=params)
+    audio_duration = get_audio_duration(sub_maker)
+
+    logger.info(f"voice: {voice_name}, audio duration: {audio_duration}s, sentences: {len(texts)}")
+    return subtitle_output_file, audio_duration, text
+
+
 if __name__ == "__main__":
 
     from app.core.story import fetch_short_story
@@ -3,13 +3,22 @@ import os
 
 from dotenv import load_dotenv
 from celery import Celery, Task
+from celery.schedules import crontab
 
 # from app.workers.celery_tasks import GenerateStory, GenerateVideo
+from app import config
+from app.core import retry
 from app.core.generator import generate_video_from_moral
 from app.core.llm import generate_story_from_moral
+from app.core.story_bank import pregenerate
 
 RESULT_EXPIRE_TIME = 60 * 60 * 10  # keep tasks around for ten hours
 
+# The retry budget of a task ends a little before its soft time limit, so upstream calls
+# are cancelled and the task cleans up before Celery interrupts it
+_soft_time_limit = config.get("celery", {}).get("soft_time_limit", 1800)
+_cleanup_seconds = 30
+
 load_dotenv()
 
 app = Celery(
@@ -24,16 +33,30 @@ app.conf.update(
     enable_utc=True,
     timezone="Asia/Saigon",
     broker_connection_retry_on_startup=True,
+    beat_schedule={
+        # Fill the story bank off-peak, so the daily render path does not call the LLM
+        "pregenerate-stories": {
+            "task": "pregenerate-stories",
+            "schedule": crontab(hour=config.get("story_bank", {}).get("schedule_hour", 2), minute=0),
+        },
+    },
 )
 
 app.autodiscover_tasks()
 
 
-@app.task(name="generate-story", bind=True)
+@app.task(name="generate-story", bind=True, soft_time_limit=_soft_time_limit, time_limit=_soft_time_limit + 60)
 def generate_story(self, moral: str):
-    return generate_story_from_moral(moral)
+    with retry.task_budget(seconds=_soft_time_limit - _cleanup_seconds):
+        return generate_story_from_moral(moral)
 
 
-@app.task(name="generate-video", bind=True)
+@app.task(name="generate-video", bind=True, soft_time_limit=_soft_time_limit, time_limit=_soft_time_limit + 60)
 def generate_video(self, moral: str, task_id: str):
-    return generate_video_from_moral(moral, task_id)
+    with retry.task_budget(seconds=_soft_time_limit - _cleanup_seconds):
+        return generate_video_from_moral(moral, task_id)
+
+
+@app.task(name="pregenerate-stories", bind=True)
+def pregenerate_stories(self, limit: int = 0):
+    return pregenerate(limit=limit)
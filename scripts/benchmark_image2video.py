@@ -0,0 +1,42 @@
+"""Compares the frames/sec of the image2video frame engines at 1080x1920@25.
+
+Run from the project root:
+    PYTHONPATH=. python scripts/benchmark_image2video.py --duration 10
+"""
+
+import argparse
+import math
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from app.core.images import image2video
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default="", help="Image to render. A random 4000x6000 image is used if empty.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Clip duration in seconds.")
+    parser.add_argument("--engines", nargs="+", default=["opencv", "ffmpeg"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_path = args.image
+        if not image_path:
+            image_path = os.path.join(temp_dir, "image.jpg")
+            cv2.imwrite(image_path, np.random.randint(0, 255, (6000, 4000, 3), dtype=np.uint8))
+
+        num_frames = math.ceil(25 * args.duration)
+        for engine in args.engines:
+            output_path = os.path.join(temp_dir, f"{engine}.mp4")
+            start = time.perf_counter()
+            image2video(image_path, output_path, args.duration, frame_engine=engine)
+            elapsed = time.perf_counter() - start
+            print(f"{engine:>8}: {num_frames} frames in {elapsed:.2f}s -> {num_frames / elapsed:.1f} frames/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Micro-benchmark of wrap_text against the previous quadratic implementation.
+
+Run from the project root:
+    PYTHONPATH=. python scripts/benchmark_wrap_text.py --repeat 20
+"""
+
+import argparse
+import time
+
+from PIL import ImageFont
+
+from app import config
+from app.core.video import wrap_text
+
+STORY = (
+    "Ngày xửa ngày xưa, trong một khu rừng xanh thẳm, có một chú cáo nhỏ tinh nghịch luôn tự hào về trí thông minh của mình. "
+    "Một buổi sáng, chú gặp bác rùa già đang chậm rãi bò qua con suối, trên lưng mang theo một chiếc giỏ đầy quả chín. "
+    "Chú cáo cười lớn và thách bác rùa chạy thi đến gốc cây sồi cổ thụ ở cuối khu rừng, nơi mà muông thú thường tụ họp mỗi chiều. "
+)
+
+
+# The implementation before the font cache and cumulative-width wrapping, kept for comparison
+def wrap_text_quadratic(text, max_width, font="Arial", fontsize=60):
+    # Create ImageFont
+    font = ImageFont.truetype(font, fontsize)
+
+    def get_text_size(inner_text):
+        inner_text = inner_text.strip()
+        left, top, right, bottom = font.getbbox(inner_text)
+        return right - left, bottom - top
+
+    width, height = get_text_size(text)
+    if width <= max_width:
+        return text, height
+
+    # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
+
+    processed = True
+
+    _wrapped_lines_ = []
+    words = text.split(" ")
+    _txt_ = ""
+    for word in words:
+        _before = _txt_
+        _txt_ += f"{word} "
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            if _txt_.strip() == word.strip():
+                processed = False
+                break
+            _wrapped_lines_.append(_before)
+            _txt_ = f"{word} "
+    _wrapped_lines_.append(_txt_)
+    if processed:
+        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
+        result = "\n".join(_wrapped_lines_).strip()
+        height = len(_wrapped_lines_) * height
+        # logger.warning(f"wrapped text: {result}")
+        return result, height
+
+    _wrapped_lines_ = []
+    chars = list(text)
+    _txt_ = ""
+    for word in chars:
+        _txt_ += word
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            _wrapped_lines_.append(_txt_)
+            _txt_ = ""
+    _wrapped_lines_.append(_txt_)
+    result = "\n".join(_wrapped_lines_).strip()
+    height = len(_wrapped_lines_) * height
+    # logger.warning(f"wrapped text: {result}")
+    return result, height
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--story-copies", type=int, default=10, help="How many times the sample story is repeated.")
+    args = parser.parse_args()
+
+    font_path = config["video"]["font_path"]
+    font_size = config["video"]["font_size"]
+    text = STORY * args.story_copies
+    print(f"text: {len(text)} characters, {len(text.split())} words")
+
+    for name, func in [("quadratic", wrap_text_quadratic), ("linear", wrap_text)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            func(text, max_width=1080 * 0.9, font=font_path, fontsize=font_size)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        print(f"{name:>10}: {elapsed * 1000:.2f} ms per call")
+
+
+if __name__ == "__main__":
+    main()